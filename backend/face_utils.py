@@ -1,36 +1,235 @@
 import numpy as np
 import insightface
 from insightface.app import FaceAnalysis
+from insightface.utils import face_align
 import cv2
+import os
 import json
+import base64
 import logging
-import concurrent.futures
-from typing import List, Dict, Any, Tuple
 import threading
+from typing import List, Dict, Any, Tuple
+
+try:
+    import faiss
+except ImportError:  # FAISS is optional, matching falls back to NumPy
+    faiss = None
+
+try:
+    import onnxruntime
+except ImportError:  # Installed with insightface; only used to pick providers
+    onnxruntime = None
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Galleries at least this large are scanned through a FAISS int8 scalar
+# quantizer index (a quarter of the float32 matrix's memory traffic)
+SQ8_MIN_USERS = 2000
+# Number of SQ8 candidates re-scored exactly against the float32 embeddings
+SQ8_RERANK = 8
+
+# Detector input size (square). SCRFD's cost grows with its area, so 320
+# roughly quarters detection time for webcam frames where faces are large;
+# must be a multiple of 32. Recognition still runs on 112x112 aligned crops
+# from the same buffalo_l model, so stored embeddings stay comparable.
+DET_SIZE = int(os.getenv("FACE_DET_SIZE", "640"))
+
+# ONNX Runtime execution providers in order of preference
+PREFERRED_PROVIDERS = ['TensorrtExecutionProvider', 'CUDAExecutionProvider', 'CPUExecutionProvider']
+# Where TensorRT keeps the engines built for each model; building them takes
+# minutes, so they are only compiled on the first start on a machine
+TRT_ENGINE_CACHE_PATH = os.getenv("TRT_ENGINE_CACHE_PATH",
+                                  os.path.join(os.path.expanduser("~"), ".insightface", "trt_engines"))
+
+
+def select_providers() -> List[str]:
+    """The preferred execution providers this ONNX Runtime build supports"""
+    if onnxruntime is None:
+        return ['CPUExecutionProvider']
+    available = onnxruntime.get_available_providers()
+    return [p for p in PREFERRED_PROVIDERS if p in available] or ['CPUExecutionProvider']
+
+
+def enable_trt_engine_cache():
+    """Have the TensorRT execution provider reuse the engines it builds across restarts"""
+    os.makedirs(TRT_ENGINE_CACHE_PATH, exist_ok=True)
+    os.environ.setdefault("ORT_TENSORRT_ENGINE_CACHE_ENABLE", "1")
+    os.environ.setdefault("ORT_TENSORRT_CACHE_PATH", TRT_ENGINE_CACHE_PATH)
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Return a contiguous float32 copy of matrix with L2-normalized rows"""
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def encode_embedding(embedding) -> str:
+    """Base64 of the embedding's raw float32 bytes, as stored in the embedding column"""
+    return base64.b64encode(np.ascontiguousarray(embedding, dtype=np.float32).tobytes()).decode("ascii")
+
+
+def decode_embedding(embedding_str: str) -> np.ndarray:
+    """Inverse of encode_embedding; also reads embeddings stored as JSON lists"""
+    if embedding_str.startswith("["):
+        return np.array(json.loads(embedding_str), dtype=np.float32)
+    return np.frombuffer(base64.b64decode(embedding_str), dtype=np.float32)
+
+
+def migrate_embedding(embedding_str: str) -> str:
+    """The stored embedding in encode_embedding's format; already migrated ones are returned unchanged"""
+    if not embedding_str.startswith("["):
+        return embedding_str
+    return encode_embedding(decode_embedding(embedding_str))
+
+
+class EmbeddingIndex:
+    """L2-normalized embeddings of a list of users, searchable by cosine similarity"""
+
+    def __init__(self, users: List[Any], embeddings: np.ndarray):
+        self.users = users
+        self.matrix = normalize_rows(embeddings)
+        # Approximate (quantized) index used to shortlist candidates, or an
+        # exact flat index for small galleries
+        self.approx_index = None
+        self.flat_index = None
+        if faiss is not None and len(users):
+            if len(users) >= SQ8_MIN_USERS:
+                self.approx_index = self._build_sq8_index(self.matrix)
+            else:
+                self.flat_index = self._build_flat_index(self.matrix)
+
+    @staticmethod
+    def _build_flat_index(matrix: np.ndarray):
+        index = faiss.IndexFlatIP(matrix.shape[1])
+        index.add(matrix)
+        return index
+
+    @staticmethod
+    def _build_sq8_index(matrix: np.ndarray):
+        index = faiss.IndexScalarQuantizer(matrix.shape[1], faiss.ScalarQuantizer.QT_8bit,
+                                           faiss.METRIC_INNER_PRODUCT)
+        index.train(matrix)
+        index.add(matrix)
+        logger.info(f"Built SQ8 index for {len(matrix)} embeddings")
+        return index
+
+    def search(self, embeddings: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the index and cosine similarity of the best user for each embedding
+
+        An index of -1 means no candidate was found.
+        """
+        probes = normalize_rows(embeddings)
+        if self.approx_index is not None:
+            # Quantized scores are approximate, so re-score the shortlisted candidates
+            _, candidates = self.approx_index.search(probes, SQ8_RERANK)
+            similarities = np.einsum('qd,qkd->qk', probes, self.matrix[candidates])
+            similarities[candidates < 0] = -1.0
+            best = similarities.argmax(axis=1)
+            rows = np.arange(len(probes))
+            return candidates[rows, best], similarities[rows, best]
+
+        if self.flat_index is not None:
+            # Exact inner-product search; rows are normalized so this is cosine
+            similarities, indices = self.flat_index.search(probes, 1)
+            return indices[:, 0], similarities[:, 0]
+
+        # Cosine similarity of every face against every user in one matrix product
+        similarities = probes @ self.matrix.T
+        best_indices = similarities.argmax(axis=1)
+        return best_indices, similarities[np.arange(len(probes)), best_indices]
+
+
+class EmbeddingIndexCache:
+    """The EmbeddingIndex of the latest user generation, rebuilt off the request path
+
+    load() builds an index over the current users. Only the first index is
+    built by the caller; after that a generation change starts a background
+    rebuild and callers keep searching the previous index until the new one
+    is swapped in, since training a quantized index can take a while. An
+    unchanged generation always reuses the index.
+    """
+
+    def __init__(self, load):
+        self._load = load
+        self._lock = threading.Lock()
+        self.index = None
+        self.generation = None
+        self._building = None
+
+    def get(self, generation: int) -> "EmbeddingIndex":
+        """The index for generation, or the previous one while it is being rebuilt"""
+        index = self.index
+        if index is not None and self.generation == generation:
+            return index
+        with self._lock:
+            if self.index is None:
+                # Nothing to search yet; build the first index in place
+                self.index, self.generation = self._load(), generation
+            elif self.generation != generation and self._building != generation:
+                self._building = generation
+                threading.Thread(target=self._rebuild, args=(generation,), daemon=True).start()
+            return self.index
+
+    def _rebuild(self, generation: int):
+        try:
+            index = self._load()
+        except Exception as e:
+            logger.error(f"Error rebuilding embedding index: {str(e)}")
+            index = None
+        with self._lock:
+            # Generations only grow; never replace a newer index with an older one
+            if index is not None and generation > self.generation:
+                self.index, self.generation = index, generation
+            if self._building == generation:
+                self._building = None
+
+
 class FaceRecognition:
     def __init__(self):
         try:
             logger.info("Initializing FaceRecognition with buffalo_l model")
-            self.app = FaceAnalysis(name='buffalo_l')
-            self.app.prepare(ctx_id=0, det_size=(640, 640))
+            self.det_size = (DET_SIZE, DET_SIZE)
+            self.providers = select_providers()
+            self.uses_gpu = self.providers[0] != 'CPUExecutionProvider'
+            logger.info(f"Using execution providers: {self.providers}")
+            if 'TensorrtExecutionProvider' in self.providers:
+                enable_trt_engine_cache()
+            self.app = FaceAnalysis(name='buffalo_l', providers=self.providers)
+            self.app.prepare(ctx_id=0 if self.uses_gpu else -1, det_size=self.det_size)
             self.threshold = 0.5 # Cosine similarity threshold for matching
-            # Create a thread pool for parallel processing
-            self.thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
             logger.info("FaceRecognition initialized successfully")
         except Exception as e:
             logger.error(f"Error initializing FaceRecognition: {str(e)}")
             raise
 
+    def resize_for_detection(self, image):
+        """Downscale an image so its longest side fits the detector input size"""
+        height, width = image.shape[:2]
+        scale = min(1.0, max(self.det_size) / max(height, width))
+        if scale < 1.0:
+            image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return image
+
+    def warm_up(self):
+        """Run the detector and the recognition model once, so the first real
+        frame doesn't pay for ONNX Runtime's lazy initialization (or for
+        TensorRT building its engines)"""
+        self.app.det_model.detect(np.zeros((*self.det_size, 3), dtype=np.uint8), max_num=0, metric='default')
+        rec_model = self.app.models['recognition']
+        size = rec_model.input_size[0]
+        rec_model.get_feat([np.zeros((size, size, 3), dtype=np.uint8)])
+
     def get_embeddings(self, image):
         """Extract face embeddings from image for all detected faces"""
         try:
             logger.info("Detecting faces in image")
-            faces = self.app.get(image)
+            # Detection and alignment cost scales with pixel count, and the
+            # detector never looks at more than det_size anyway
+            faces = self.app.get(self.resize_for_detection(image))
             if not faces:
                 logger.warning("No faces detected in image")
                 return []
@@ -42,6 +241,44 @@ class FaceRecognition:
             logger.error(f"Error extracting face embeddings: {str(e)}")
             return []
 
+    def get_embeddings_batch(self, images):
+        """Extract face embeddings for a batch of images, one list of embeddings per image
+
+        The InsightFace detector takes one image per call, so detection runs
+        image by image; the aligned crops of every face found in the batch
+        then go through the recognition model in a single call.
+        """
+        rec_model = self.app.models['recognition']
+        crops, owners = [], []
+        for i, image in enumerate(images):
+            try:
+                image = self.resize_for_detection(image)
+                _, kpss = self.app.det_model.detect(image, max_num=0, metric='default')
+            except Exception as e:
+                logger.error(f"Error detecting faces in batch image: {str(e)}")
+                continue
+            if kpss is None:
+                continue
+            for kps in kpss:
+                crops.append(face_align.norm_crop(image, landmark=kps, image_size=rec_model.input_size[0]))
+                owners.append(i)
+
+        results = [[] for _ in images]
+        if not crops:
+            logger.warning("No faces detected in batch")
+            return results
+
+        try:
+            features = rec_model.get_feat(crops)
+        except Exception as e:
+            logger.error(f"Error extracting face embeddings for batch: {str(e)}")
+            return results
+
+        for owner, feature in zip(owners, features):
+            results[owner].append(feature.flatten())
+        logger.info(f"Found {len(crops)} faces in {len(images)} images")
+        return results
+
     def get_embedding(self, image):
         """Extract face embedding from image (legacy method for backward compatibility)"""
         embeddings = self.get_embeddings(image)
@@ -72,7 +309,7 @@ class FaceRecognition:
     def embedding_to_str(self, embedding):
         """Convert numpy array to string for storage"""
         try:
-            return json.dumps(embedding.tolist())
+            return encode_embedding(embedding)
         except Exception as e:
             logger.error(f"Error converting embedding to string: {str(e)}")
             raise
@@ -80,54 +317,42 @@ class FaceRecognition:
     def str_to_embedding(self, embedding_str):
         """Convert stored string back to numpy array"""
         try:
-            return np.array(json.loads(embedding_str))
+            return decode_embedding(embedding_str)
         except Exception as e:
             logger.error(f"Error converting string to embedding: {str(e)}")
             raise
 
-    def find_match_for_user(self, query_embedding: np.ndarray, user: Any, threshold: float) -> Tuple[Any, float]:
-        """Find match for a single user (to be used in parallel)"""
-        stored_embedding = self.str_to_embedding(user.embedding)
-        similarity = self.compare_faces(query_embedding, stored_embedding)
-        return user, similarity
+    def build_embedding_index(self, users: List[Any], embeddings: List[str] = None) -> "EmbeddingIndex":
+        """Build a searchable index over the users' stored embeddings
 
-    def find_matches_for_embeddings(self, query_embeddings: List[np.ndarray], users: List[Any], threshold: float = None) -> List[Dict[str, Any]]:
-        """Find matches for multiple face embeddings using parallel processing"""
+        embeddings are the stored embedding strings in the same order as
+        users; by default they are read from each user's embedding attribute.
+        """
+        if not users:
+            return EmbeddingIndex(users, np.empty((0, 0), dtype=np.float32))
+        if embeddings is None:
+            embeddings = [user.embedding for user in users]
+        return EmbeddingIndex(users, np.stack([self.str_to_embedding(embedding) for embedding in embeddings]))
+
+    def find_matches_for_embeddings(self, query_embeddings: List[np.ndarray], users: List[Any], threshold: float = None,
+                                    embedding_index: "EmbeddingIndex" = None) -> List[Dict[str, Any]]:
+        """Find the best matching user for each face embedding
+
+        embedding_index is the output of build_embedding_index(users); pass a
+        cached one to avoid re-parsing and re-normalizing stored embeddings.
+        """
         if threshold is None:
             threshold = self.threshold
-            
-        matches = []
-        
-        for query_embedding in query_embeddings:
-            # Submit all user comparisons to thread pool
-            futures = []
-            for user in users:
-                future = self.thread_pool.submit(
-                    self.find_match_for_user,
-                    query_embedding,
-                    user,
-                    threshold
-                )
-                futures.append(future)
-            
-            # Get results and find best match
-            best_match = None
-            best_similarity = 0.0
-            
-            for future in concurrent.futures.as_completed(futures):
-                user, similarity = future.result()
-                if similarity > best_similarity:
-                    best_similarity = similarity
-                    best_match = user
-            
-            if best_similarity >= threshold and best_match:
-                matches.append({
-                    'user': best_match,
-                    'similarity': best_similarity
-                })
-                
-        return matches
-
-    def __del__(self):
-        """Clean up thread pool when object is destroyed"""
-        self.thread_pool.shutdown(wait=True) 
\ No newline at end of file
+        if not query_embeddings or not users:
+            return []
+        if embedding_index is None:
+            embedding_index = self.build_embedding_index(users)
+
+        best_indices, best_similarities = embedding_index.search(np.stack(query_embeddings))
+
+        # Faces whose best user clears the threshold
+        matched = np.flatnonzero((best_indices >= 0) & (best_similarities >= threshold))
+        return [{
+            'user': embedding_index.users[best_indices[i]],
+            'similarity': float(best_similarities[i])
+        } for i in matched]
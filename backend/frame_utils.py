@@ -0,0 +1,113 @@
+import time
+
+import cv2
+import numpy as np
+
+
+# Start-of-frame markers carrying a JPEG's dimensions (not DHT/JPG/DAC)
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# Markers with no length field after them: TEM and RST0-RST7
+JPEG_STANDALONE_MARKERS = {0x01, *range(0xD0, 0xD8)}
+# Start of scan and end of image; a frame header has to come before either
+JPEG_SOS, JPEG_EOI = 0xDA, 0xD9
+
+# imdecode flags that let libjpeg decode at 1/2, 1/4 or 1/8 scale
+REDUCED_DECODE_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                        (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def jpeg_size(data: bytes):
+    """(height, width) from a JPEG header, or None if it isn't a readable JPEG"""
+    if data[:2] != b"\xff\xd8":
+        return None
+    pos = 2
+    while pos + 1 < len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # Fill byte; the marker is in a later byte
+            pos += 1
+        elif marker in JPEG_STANDALONE_MARKERS:
+            pos += 2
+        elif marker in JPEG_SOF_MARKERS:
+            if pos + 9 > len(data):
+                return None
+            return int.from_bytes(data[pos + 5:pos + 7], "big"), int.from_bytes(data[pos + 7:pos + 9], "big")
+        elif marker in (JPEG_SOS, JPEG_EOI) or pos + 4 > len(data):
+            return None
+        else:
+            length = int.from_bytes(data[pos + 2:pos + 4], "big")
+            if length < 2:
+                return None
+            pos += 2 + length
+    return None
+
+
+def decode_flags(size, det_size: int) -> int:
+    """imdecode flags for an image of size (height, width), given the detector's input size
+
+    Picks the largest libjpeg reduction that still leaves the long side at
+    det_size or more; unknown sizes are decoded in full.
+    """
+    if size is not None:
+        for factor, reduced_flags in REDUCED_DECODE_FLAGS:
+            if max(size) // factor >= det_size:
+                return reduced_flags
+    return cv2.IMREAD_COLOR
+
+
+def imdecode_for_detection(image_bytes: bytes, det_size: int):
+    """Decode an image, letting libjpeg downscale large JPEGs that would only be shrunk afterwards"""
+    flags = decode_flags(jpeg_size(image_bytes), det_size)
+    return cv2.imdecode(np.frombuffer(image_bytes, np.uint8), flags)
+
+
+def difference_hash(img) -> int:
+    """64-bit difference hash of a frame, used to spot near-identical frames"""
+    small = cv2.resize(img, (9, 8), interpolation=cv2.INTER_AREA)
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    return int.from_bytes(np.packbits(gray[:, 1:] > gray[:, :-1]).tobytes(), "big")
+
+
+def hamming_distance(hash1: int, hash2: int) -> int:
+    """Number of bits in which two frame hashes differ"""
+    # int.bit_count() would need Python 3.10
+    return bin(hash1 ^ hash2).count("1")
+
+
+class FrameResultCache:
+    """The last frame hash and reply per client, replayed for near-duplicate frames
+
+    A frame within max_distance bits of the client's previous frame gets the
+    previous reply again, as long as that reply was for the same entry type
+    and is younger than ttl seconds.
+    """
+
+    def __init__(self, max_distance: int, ttl: float):
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self._results = {}
+
+    def recall(self, client_id: str, entry_type: str, frame_hash: int):
+        """The previous reply for this client if the new frame is a near-duplicate of its frame"""
+        previous = self._results.get(client_id)
+        if previous is None:
+            return None
+        previous_hash, previous_entry_type, processed_at, item = previous
+        if (previous_entry_type != entry_type
+                or time.monotonic() - processed_at > self.ttl
+                or hamming_distance(previous_hash, frame_hash) > self.max_distance):
+            return None
+        return item
+
+    def remember(self, client_id: str, entry_type: str, frame_hash: int, item):
+        """Keep the reply sent for a frame so near-duplicates can get it again"""
+        self._results[client_id] = (frame_hash, entry_type, time.monotonic(), item)
+
+    def forget(self, client_id: str):
+        self._results.pop(client_id, None)
+
+    def clear(self):
+        """Drop every cached reply (clear() on a dict is atomic, so any thread may call it)"""
+        self._results.clear()
@@ -1,9 +1,11 @@
 from fastapi import FastAPI, File, UploadFile, Depends, HTTPException, Form, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
-from datetime import datetime, date, timezone, timedelta
-import cv2
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from sqlalchemy import event, Index, and_, or_, false
+from sqlalchemy.orm import Session, joinedload, scoped_session, sessionmaker
+from datetime import datetime, date, timezone, timedelta, time as dtime
 import numpy as np
+import orjson
 from typing import List, Dict, Any, Optional
 import base64
 import json
@@ -11,28 +13,51 @@ import asyncio
 import logging
 import pytz
 import multiprocessing
-from multiprocessing import Process, Queue, Manager
+from multiprocessing import shared_memory
 import concurrent.futures
 import threading
-from queue import Queue as ThreadQueue
 import time
+import atexit
 import os
-import signal
 import uuid
+import itertools
+from collections import namedtuple
 
 import models
 import database
-from face_utils import FaceRecognition
+from face_utils import EmbeddingIndexCache, FaceRecognition
+from frame_utils import FrameResultCache, difference_hash, imdecode_for_detection
 from database import engine, get_db
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Tune every new SQLite connection: WAL lets reads proceed while an attendance
+# write is in progress, and synchronous=NORMAL avoids an fsync per commit
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if engine.dialect.name != "sqlite":
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
 # Create database tables
 models.Base.metadata.create_all(bind=engine)
 
-app = FastAPI()
+# Today's-attendance lookups filter on user_id and a timestamp range; the
+# composite index turns them into a single index range scan, and the
+# timestamp index serves the newest-first attendance listing. Created here
+# (if missing) so existing databases pick them up too.
+Index("ix_attendance_user_id_timestamp",
+      models.Attendance.user_id, models.Attendance.timestamp).create(bind=engine, checkfirst=True)
+Index("ix_attendance_timestamp", models.Attendance.timestamp).create(bind=engine, checkfirst=True)
+
+app = FastAPI(default_response_class=ORJSONResponse)
 face_recognition = FaceRecognition()
 
 # Configure CORS
@@ -47,28 +72,84 @@ app.add_middleware(
 # Store active WebSocket connections
 active_connections = {}
 
-# Create a process pool for image processing
-process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=multiprocessing.cpu_count())
+def init_face_worker(user_generation, attendance_generation, timezone_generation, office_timing_generation):
+    """Prepare a process pool worker once, before it takes any frames"""
+    # Use the parent's cache generation counters. A spawned worker re-imports
+    # this module and would otherwise get counters no invalidation reaches.
+    global shared_user_cache_generation, shared_attendance_generation
+    global shared_timezone_generation, shared_office_timing_generation
+    shared_user_cache_generation = user_generation
+    shared_attendance_generation = attendance_generation
+    shared_timezone_generation = timezone_generation
+    shared_office_timing_generation = office_timing_generation
+    # Connections inherited from the parent must not be shared across the
+    # fork; each worker opens and keeps its own
+    engine.dispose(close=False)
+    warm_up_face_recognition()
+
+def warm_up_face_recognition():
+    """Run the models once before any frame arrives"""
+    try:
+        face_recognition.warm_up()
+    except Exception as e:
+        logger.error(f"Error warming up face recognition: {str(e)}")
+
+# Session per recognition worker (thread or process), reused across frames.
+# Records aren't expired on commit since the worker is done with them by then.
+recognition_session = scoped_session(sessionmaker(bind=engine, expire_on_commit=False))
 
-# Create multiprocessing queues
-manager = Manager()
-processing_results_queue = manager.Queue(maxsize=100)
-websocket_responses_queue = manager.Queue(maxsize=100)
+# Threads recognizing frames when the models run on a GPU execution provider
+GPU_RECOGNITION_THREADS = 4
 
-# Dictionary to store pending futures
-pending_futures = {}
+# Bounded thread pool used as the default executor for blocking calls
+# (cv2.imdecode, frame file writes) so they don't stall the event loop
+decode_executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count())
 
-# User cache to avoid frequent database queries
-user_cache = manager.dict()
-user_cache_lock = manager.Lock()
-user_cache_last_updated = manager.Value('d', 0)
-USER_CACHE_TTL = 300  # 5 minutes
+# Maximum number of frames whose embeddings are extracted in one batch
+EMBEDDING_BATCH_SIZE = 8
+
+# How long the first frame of a batch waits for more frames to arrive
+EMBEDDING_BATCH_DELAY_MS = 8
 
-# WebSocket ping interval in seconds (30 seconds)
-PING_INTERVAL = 30
+# How often the batcher checks for more frames while a batch is open
+EMBEDDING_BATCH_POLL_MS = 1
 
-# WebSocket ping timeout in seconds (60 seconds)
-PING_TIMEOUT = 60
+# Broadcasts queued by code that isn't running on the event loop (sync
+# endpoints on worker threads), drained by process_queue
+processing_results_queue = asyncio.Queue()
+
+# The server's event loop, set on startup
+event_loop = None
+
+# Frame processing tasks in flight, referenced until they finish
+frame_tasks = set()
+
+# User cache to avoid frequent database queries. Each process (including the
+# process pool workers) keeps its own copy of the users and, separately, of
+# the embedding index built from them, so listing users never builds the
+# index; the shared generation counter (handed to the pool workers by
+# init_face_worker) is bumped whenever users change so every copy gets
+# reloaded. The user list also expires after USER_CACHE_TTL; the index is
+# only rebuilt (in the background) when the generation changes.
+user_cache = {"users": [], "loaded_at": 0.0, "generation": None}
+user_cache_lock = threading.Lock()
+shared_user_cache_generation = multiprocessing.Value('L', 0)
+USER_CACHE_TTL = 300  # 5 minutes
+
+# What the cache keeps per user; embeddings live in the index's matrix
+CachedUser = namedtuple("CachedUser", ["user_id", "name", "created_at"])
+
+# Today's entry/exit times of recently processed users, keyed by
+# (user_id, date). A face seen again within RECENT_ACTION_TTL seconds gets
+# its "already marked" reply from here without querying attendance, and
+# users who already exited are answered from here for the rest of the day.
+# Each entry carries the shared generation counter it was read under, which
+# is bumped whenever attendance records are deleted; entries from an older
+# generation are ignored. The cache is cleared at date rollover.
+recent_actions = {}
+recent_actions_day = None
+shared_attendance_generation = multiprocessing.Value('L', 0)
+RECENT_ACTION_TTL = 5
 
 # Maximum number of frames to process per second
 MAX_FRAMES_PER_SECOND = 1
@@ -76,9 +157,32 @@ MAX_FRAMES_PER_SECOND = 1
 # Maximum number of concurrent image processing tasks per client
 MAX_CONCURRENT_TASKS_PER_CLIENT = 2
 
-# Dictionary to track number of pending tasks per client
-client_pending_tasks = manager.dict()
-client_pending_tasks_lock = manager.Lock()
+# Maximum number of outgoing messages buffered per client before new ones are dropped
+CLIENT_OUTBOX_SIZE = 64
+
+# Number of shared memory blocks used to pass decoded frames to the process pool
+SHARED_FRAME_SLOTS = multiprocessing.cpu_count() * MAX_CONCURRENT_TASKS_PER_CLIENT
+
+# Frames handed to recognition threads at once (GPU mode). On CPU the shared
+# frame blocks bound the frames in flight the same way.
+MAX_INFLIGHT_FRAMES = GPU_RECOGNITION_THREADS * MAX_CONCURRENT_TASKS_PER_CLIENT
+inflight_frames = asyncio.Semaphore(MAX_INFLIGHT_FRAMES)
+
+# Dictionary to track number of pending tasks per client (event loop only)
+client_pending_tasks = {}
+
+# Monotonic time of the last frame accepted from each client (event loop only)
+last_frame_times = {}
+
+# Last frame hash and reply per client (event loop only). A frame within
+# FRAME_DEDUP_MAX_DISTANCE bits of the previous one gets the previous reply
+# again instead of going to the pool, as long as that reply is younger than
+# FRAME_DEDUP_TTL and changed no attendance. Cleared (possibly from a worker
+# thread) whenever users or attendance records change, since a cached reply
+# may no longer hold.
+FRAME_DEDUP_MAX_DISTANCE = 3
+FRAME_DEDUP_TTL = 5.0
+last_frame_results = FrameResultCache(FRAME_DEDUP_MAX_DISTANCE, FRAME_DEDUP_TTL)
 
 # Get local timezone
 def get_configured_timezone(db: Session):
@@ -97,31 +201,95 @@ def get_configured_timezone(db: Session):
         # Fallback to IST
         return timezone(timedelta(hours=5, minutes=30))
 
-def get_local_time():
+# Configured timezone cache; the shared generation is bumped when the
+# timezone is changed so pool workers pick up the new value too
+TIMEZONE_CACHE_TTL = 300  # 5 minutes
+_timezone_cache = {"tz": None, "loaded_at": 0.0, "generation": 0}
+shared_timezone_generation = multiprocessing.Value('L', 0)
+
+def get_cached_timezone():
+    """Get the configured timezone, querying the database at most once per TTL"""
+    current_time = time.monotonic()
+    generation = shared_timezone_generation.value
+    if (_timezone_cache["tz"] is None
+            or current_time - _timezone_cache["loaded_at"] > TIMEZONE_CACHE_TTL
+            or _timezone_cache["generation"] != generation):
+        db = next(get_db())
+        try:
+            _timezone_cache["tz"] = get_configured_timezone(db)
+        finally:
+            db.close()
+        _timezone_cache["loaded_at"] = current_time
+        _timezone_cache["generation"] = generation
+    return _timezone_cache["tz"]
+
+def invalidate_timezone_cache():
+    """Force the next get_cached_timezone call to reload the timezone"""
+    with shared_timezone_generation.get_lock():
+        shared_timezone_generation.value += 1
+
+# Office timing cache, invalidated the same way as the timezone cache
+OFFICE_TIMING_CACHE_TTL = 300  # 5 minutes
+OfficeTimingSettings = namedtuple("OfficeTimingSettings", ["login_time", "logout_time"])
+_office_timing_cache = {"timing": None, "loaded_at": 0.0, "generation": None}
+shared_office_timing_generation = multiprocessing.Value('L', 0)
+
+def get_cached_office_timing(db: Session):
+    """Get the configured office timings (or None), querying at most once per TTL"""
+    current_time = time.monotonic()
+    generation = shared_office_timing_generation.value
+    if (current_time - _office_timing_cache["loaded_at"] > OFFICE_TIMING_CACHE_TTL
+            or _office_timing_cache["generation"] != generation):
+        timing = db.query(models.OfficeTiming).first()
+        # Keep plain values rather than the ORM row, which is tied to db
+        _office_timing_cache["timing"] = OfficeTimingSettings(
+            timing.login_time, timing.logout_time) if timing else None
+        _office_timing_cache["loaded_at"] = current_time
+        _office_timing_cache["generation"] = generation
+    return _office_timing_cache["timing"]
+
+def invalidate_office_timing_cache():
+    """Force the next get_cached_office_timing call to reload the timings"""
+    with shared_office_timing_generation.get_lock():
+        shared_office_timing_generation.value += 1
+
+# Create a pool for image processing. On CPU, worker processes persist and
+# keep their warmed-up models between frames. On a GPU, inference releases
+# the GIL, so threads share the models already loaded in this process
+# instead of every worker putting its own copy on the device.
+if face_recognition.uses_gpu:
+    recognition_pool = concurrent.futures.ThreadPoolExecutor(max_workers=GPU_RECOGNITION_THREADS)
+else:
+    recognition_pool = concurrent.futures.ProcessPoolExecutor(
+        max_workers=multiprocessing.cpu_count(), initializer=init_face_worker,
+        initargs=(shared_user_cache_generation, shared_attendance_generation,
+                  shared_timezone_generation, shared_office_timing_generation))
+
+def get_local_time(local_tz=None):
     """Get current time in configured timezone"""
-    db = next(get_db())
-    try:
-        local_tz = get_configured_timezone(db)
-        return datetime.now(local_tz)
-    finally:
-        db.close()
+    return datetime.now(local_tz or get_cached_timezone())
+
+def _hhmm(dt):
+    """Format the hour and minute of a datetime/time as HH:MM without strftime"""
+    return f"{dt.hour:02d}:{dt.minute:02d}"
+
+def _parse_hhmm(value: str) -> dtime:
+    """Parse an HH:MM string into a time without strptime"""
+    hour, minute = map(int, value.split(":"))
+    return dtime(hour, minute)
 
 def get_local_date():
     """Get current date in local timezone"""
     return get_local_time().date()
 
-def convert_to_local_time(dt):
+def convert_to_local_time(dt, local_tz=None):
     """Convert a datetime to configured timezone"""
     if dt is None:
         return None
-    db = next(get_db())
-    try:
-        local_tz = get_configured_timezone(db)
-        if dt.tzinfo is None:
-            dt = local_tz.localize(dt)
-        return dt.astimezone(local_tz)
-    finally:
-        db.close()
+    local_tz = local_tz or get_cached_timezone()
+    if dt.tzinfo is None:
+        dt = local_tz.localize(dt)
+    return dt.astimezone(local_tz)
 
 # Create images directory if it doesn't exist
 IMAGES_DIR = "images"
@@ -129,179 +297,414 @@ if not os.path.exists(IMAGES_DIR):
     os.makedirs(IMAGES_DIR)
     logger.info(f"Created images directory: {IMAGES_DIR}")
 
-# Process cleanup handler
-def cleanup_processes():
-    """Clean up all processes when the application exits"""
-    for process in multiprocessing.active_children():
-        process.terminate()
-    process_pool.shutdown(wait=True)
+# Uploaded frames are only persisted to IMAGES_DIR when this is enabled
+SAVE_FRAMES = os.getenv("SAVE_FRAMES", "false").lower() == "true"
 
-# Register cleanup handler
-signal.signal(signal.SIGTERM, lambda signum, frame: cleanup_processes())
-signal.signal(signal.SIGINT, lambda signum, frame: cleanup_processes())
+# Maximum number of frames written to disk per batch by the frame writer
+FRAME_WRITE_BATCH_SIZE = 32
 
-def get_cached_users(db: Session):
-    """Get users from cache or database with TTL"""
-    global user_cache, user_cache_last_updated
+# Frames waiting to be written to disk by the background frame writer
+frame_save_queue = asyncio.Queue(maxsize=1024)
+frame_counter = itertools.count()
+
+def save_frame(prefix: str, contents: bytes):
+    """Queue the raw JPEG bytes of a frame to be written to disk in the background"""
+    if not SAVE_FRAMES:
+        return
+    # Nanosecond timestamp plus a counter keeps names unique without strftime
+    filepath = os.path.join(IMAGES_DIR, f"{prefix}_{time.time_ns()}_{next(frame_counter)}.jpg")
+    try:
+        frame_save_queue.put_nowait((filepath, contents))
+    except asyncio.QueueFull:
+        logger.warning(f"Frame save queue full, dropping {filepath}")
+
+def _flush_frames(frames):
+    """Write a batch of (filepath, contents) frames to disk"""
+    for filepath, contents in frames:
+        try:
+            with open(filepath, "wb") as f:
+                f.write(contents)
+        except OSError as e:
+            logger.error(f"Error saving frame to {filepath}: {str(e)}")
+
+async def frame_writer():
+    """Drain the frame save queue and write frames to disk in batches"""
+    while True:
+        frames = [await frame_save_queue.get()]
+        while len(frames) < FRAME_WRITE_BATCH_SIZE and not frame_save_queue.empty():
+            frames.append(frame_save_queue.get_nowait())
+        try:
+            await asyncio.to_thread(_flush_frames, frames)
+        except Exception as e:
+            logger.error(f"Error writing frames: {str(e)}")
+
+# Shut the process pool down on exit without waiting for queued frames.
+# Uvicorn handles SIGINT/SIGTERM itself and then lets the interpreter exit.
+atexit.register(recognition_pool.shutdown, wait=False, cancel_futures=True)
+
+def _user_cache_is_stale(cache) -> bool:
+    """Check whether a user cache snapshot has expired or been invalidated"""
+    return (time.time() - cache["loaded_at"] > USER_CACHE_TTL
+            or cache["generation"] != shared_user_cache_generation.value)
+
+def _load_cached_users(db: Session):
+    """Return the current user cache snapshot, refreshing it if needed
+
+    Only one caller refreshes at a time; callers that waited on the lock
+    re-check the snapshot and reuse the one just built.
+    """
+    global user_cache
+    cache = user_cache
+    if not _user_cache_is_stale(cache):
+        return cache
 
-    current_time = time.time()
     with user_cache_lock:
-        if current_time - user_cache_last_updated.value > USER_CACHE_TTL or not user_cache:
-            # Update cache
-            users = db.query(models.User).all()
-            user_cache.clear()
-            user_cache.update({user.user_id: user for user in users})
-            user_cache_last_updated.value = current_time
+        cache = user_cache
+        if _user_cache_is_stale(cache):
+            generation = shared_user_cache_generation.value
+            rows = db.query(models.User.user_id, models.User.name, models.User.created_at).all()
+            cache = {
+                "users": [CachedUser(row.user_id, row.name, row.created_at) for row in rows],
+                "loaded_at": time.time(),
+                "generation": generation,
+            }
+            user_cache = cache
             logger.info("User cache updated")
-        return list(user_cache.values())
+        return cache
 
-# Function to process the queue and broadcast updates
+def load_user_index():
+    """Build the embedding index over all users (runs on the index rebuild thread too)"""
+    db = next(get_db())
+    try:
+        rows = db.query(
+            models.User.user_id, models.User.name, models.User.created_at, models.User.embedding).all()
+    finally:
+        db.close()
+    users = [CachedUser(row.user_id, row.name, row.created_at) for row in rows]
+    index = face_recognition.build_embedding_index(users, [row.embedding for row in rows])
+    logger.info("User embedding index updated")
+    return index
 
+user_index_cache = EmbeddingIndexCache(load_user_index)
 
-async def process_queue():
-    """Process the queue and broadcast updates to all connected clients"""
-    while True:
-        try:
-            # Check if there are any items in the queue
-            if not processing_results_queue.empty():
-                # Get the next item from the queue
-                item = processing_results_queue.get()
+def get_cached_users(db: Session):
+    """Get users from cache or database with TTL"""
+    return _load_cached_users(db)["users"]
+
+def get_cached_user_embeddings():
+    """Get the cached users and the embedding index built from them"""
+    index = user_index_cache.get(shared_user_cache_generation.value)
+    return index.users, index
+
+def invalidate_user_cache():
+    """Force the next get_cached_users call to reload users from the database"""
+    with shared_user_cache_generation.get_lock():
+        shared_user_cache_generation.value += 1
+    # A user registered just now must not keep getting a cached "no match"
+    last_frame_results.clear()
+
+def dumps(message) -> str:
+    """Serialize a message to JSON with orjson (handles numpy scalars)"""
+    return orjson.dumps(message, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+async def send_json_message(websocket: WebSocket, message):
+    """Send a JSON message over a WebSocket using orjson instead of json.dumps"""
+    await websocket.send_text(dumps(message))
+
+# Attendance result messages sent back to clients
+MSG_ENTRY_ALREADY_MARKED = "Entry already marked for today"
+MSG_ENTRY_AFTER_EXIT = "Cannot mark entry again for today after exit"
+MSG_ENTRY_MARKED = "Entry marked successfully"
+MSG_NO_ENTRY_FOUND = "No entry record found for today"
+MSG_EXIT_ALREADY_MARKED = "Exit already marked for today"
+MSG_EXIT_RECORDED = "Exit recorded successfully"
+
+# Fixed status frames, encoded once at import
+NO_FACE_DETECTED_FRAME = dumps({"status": "no_face_detected"})
+NO_MATCHING_USERS_FRAME = dumps({"status": "no_matching_users"})
+
+class FrameBatcher:
+    """Coalesces frames from concurrent requests into batched embedding extraction"""
+
+    def __init__(self, max_batch: int = EMBEDDING_BATCH_SIZE, max_delay_ms: int = EMBEDDING_BATCH_DELAY_MS):
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self.queue = asyncio.Queue()
+
+    async def submit(self, img):
+        """Queue a decoded frame and wait for its face embeddings"""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((img, future))
+        return await future
+
+    async def run(self):
+        """Collect frames for up to max_delay and extract their embeddings in one call"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            # Poll with get_nowait rather than wait_for(queue.get()): before
+            # Python 3.12 a get completing just as the timeout cancels it
+            # loses the frame, and its request would wait forever
+            while True:
+                while len(batch) < self.max_batch and not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                timeout = deadline - loop.time()
+                if len(batch) >= self.max_batch or timeout <= 0:
+                    break
+                await asyncio.sleep(min(timeout, EMBEDDING_BATCH_POLL_MS / 1000))
 
-                # Process the item based on its type
-                if item.get("type") == "attendance_update":
-                    # Broadcast the attendance update
-                    await broadcast_attendance_update(item.get("data", []))
+            try:
+                results = await asyncio.to_thread(
+                    face_recognition.get_embeddings_batch, [img for img, _ in batch])
+            except Exception as e:
+                logger.error(f"Error extracting embeddings for batch: {str(e)}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
 
-                # Mark the task as done
-                processing_results_queue.task_done()
+            for (_, future), embeddings in zip(batch, results):
+                if not future.done():
+                    future.set_result(embeddings)
 
-            # Sleep for a short time to avoid busy waiting
-            await asyncio.sleep(0.1)
-        except Exception as e:
-            logger.error(f"Error processing queue: {str(e)}")
-            # Sleep for a longer time if there was an error
-            await asyncio.sleep(1)
+frame_batcher = FrameBatcher()
 
-# Function to handle future completion
+class ClientConnection:
+    """A WebSocket client whose outgoing frames are written by a single task"""
 
+    def __init__(self, client_id: str, websocket: WebSocket, max_queued: int = CLIENT_OUTBOX_SIZE):
+        self.client_id = client_id
+        self.websocket = websocket
+        self.outbox = asyncio.Queue(maxsize=max_queued)
+        self.writer_task = asyncio.create_task(self._writer())
 
-def handle_future_completion(future, client_id):
+    def send_text(self, payload: str) -> bool:
+        """Queue an encoded frame; returns False if the client is too far behind"""
+        try:
+            self.outbox.put_nowait(payload)
+            return True
+        except asyncio.QueueFull:
+            logger.warning(f"Outbox full for client {self.client_id}, dropping message")
+            return False
+
+    def send_json(self, message) -> bool:
+        """Encode and queue a JSON message"""
+        return self.send_text(dumps(message))
+
+    async def _writer(self):
+        """Drain the outbox onto the socket"""
+        try:
+            while True:
+                payload = await self.outbox.get()
+                await self.websocket.send_text(payload)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Error sending to client {self.client_id}: {str(e)}")
+            if active_connections.get(self.client_id) is self:
+                del active_connections[self.client_id]
+
+    def close(self):
+        """Stop the writer task"""
+        self.writer_task.cancel()
+
+class SharedFramePool:
+    """Fixed set of shared memory blocks for handing decoded frames to the process pool
+
+    Frames are downscaled to the detector size first, so one block always
+    holds a full frame and only the block name and shape are pickled.
+    """
+
+    def __init__(self, slots: int = SHARED_FRAME_SLOTS):
+        self.slots = slots
+        self.slot_size = max(face_recognition.det_size) ** 2 * 3
+        self.blocks = []
+        self.free = asyncio.Queue()
+
+    def start(self):
+        """Allocate the blocks (main process only)"""
+        for _ in range(self.slots):
+            block = shared_memory.SharedMemory(create=True, size=self.slot_size)
+            self.blocks.append(block)
+            self.free.put_nowait(block)
+
+    async def acquire(self):
+        """Wait for a free block"""
+        return await self.free.get()
+
+    def release(self, block):
+        """Return a block once the worker is done with it"""
+        self.free.put_nowait(block)
+
+    @staticmethod
+    def write(block, img):
+        """Copy a frame into a block"""
+        np.ndarray(img.shape, dtype=np.uint8, buffer=block.buf)[...] = img
+
+    def close(self):
+        """Free the blocks"""
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+shared_frames = SharedFramePool()
+
+# Shared memory blocks attached by a pool worker, by name
+_attached_frames = {}
+
+def read_shared_frame(name: str, shape):
+    """View a frame written by SharedFramePool.write without copying it (pool workers)"""
+    block = _attached_frames.get(name)
+    if block is None:
+        block = shared_memory.SharedMemory(name=name)
+        _attached_frames[name] = block
+    return np.ndarray(shape, dtype=np.uint8, buffer=block.buf)
+
+def decode_image(image_bytes: bytes):
+    """Decode an encoded image and downscale it to the detector size
+
+    Runs on the decode threads so the embedding batch thread (and the pool
+    workers) only ever see detector-sized frames.
+    """
+    img = imdecode_for_detection(image_bytes, max(face_recognition.det_size))
+    if img is None:
+        return None
+    return np.ascontiguousarray(face_recognition.resize_for_detection(img))
+
+def decode_frame(image_data: str):
+    """Decode a base64 frame and downscale it to the detector size"""
+    # Remove data URL prefix if present
+    if "," in image_data:
+        image_data = image_data.split(",")[1]
+
+    return decode_image(base64.b64decode(image_data))
+
+def decode_and_hash(image_data):
+    """Decode a WebSocket frame (base64 string or raw bytes) and hash it"""
+    img = decode_image(image_data) if isinstance(image_data, bytes) else decode_frame(image_data)
+    return img, (difference_hash(img) if img is not None else None)
+
+async def process_frame(client_id: str, image_data, entry_type: str):
+    """Decode a WebSocket frame, recognize faces in the process pool and reply to the client
+
+    image_data is either a base64 (data URL) string from a JSON message or
+    the raw encoded bytes of a binary frame. The frame reaches the worker
+    through shared memory; the worker's result is awaited directly on the
+    event loop.
+    """
+    block = None
     try:
-        processed_users, attendance_updates, last_recognized_users, no_face_count = future.result()
-
-        # Decrement pending tasks counter
-        with client_pending_tasks_lock:
-            if client_id in client_pending_tasks:
-                client_pending_tasks[client_id] = max(0, client_pending_tasks[client_id] - 1)
-
-        # Put the results in the websocket responses queue
-        websocket_responses_queue.put({
-            "client_id": client_id,
-            "processed_users": processed_users,
-            "attendance_updates": attendance_updates,
-            "last_recognized_users": last_recognized_users,
-            "no_face_count": no_face_count
-        })
+        img, frame_hash = await asyncio.to_thread(decode_and_hash, image_data)
+        # Near-duplicates of the previous frame get the previous reply
+        item = last_frame_results.recall(client_id, entry_type, frame_hash) if img is not None else None
+        if item is None:
+            if img is None:
+                processed_users, attendance_updates, last_recognized_users, no_face_count = [], [], {}, 0
+            elif face_recognition.uses_gpu:
+                # Pool threads share this process's memory, so the frame is passed as is
+                async with inflight_frames:
+                    processed_users, attendance_updates, last_recognized_users, no_face_count = \
+                        await asyncio.get_running_loop().run_in_executor(
+                            recognition_pool, recognize_frame, img, entry_type, client_id)
+            else:
+                block = await shared_frames.acquire()
+                shared_frames.write(block, img)
+                processed_users, attendance_updates, last_recognized_users, no_face_count = \
+                    await asyncio.get_running_loop().run_in_executor(
+                        recognition_pool,
+                        process_image_in_process,
+                        block.name,
+                        img.shape,
+                        entry_type,
+                        client_id
+                    )
+            item = {
+                "client_id": client_id,
+                "processed_users": processed_users,
+                "attendance_updates": attendance_updates,
+                "last_recognized_users": last_recognized_users,
+                "no_face_count": no_face_count
+            }
+            if img is not None and not attendance_updates:
+                # Only replies that changed no attendance are safe to repeat
+                last_frame_results.remember(client_id, entry_type, frame_hash, item)
     except Exception as e:
-        logger.error(f"Error handling future completion: {str(e)}")
-        # Decrement pending tasks counter even on error
-        with client_pending_tasks_lock:
-            if client_id in client_pending_tasks:
-                client_pending_tasks[client_id] = max(0, client_pending_tasks[client_id] - 1)
-        # Put error in the queue
-        websocket_responses_queue.put({
-            "client_id": client_id,
-            "error": str(e)
-        })
+        logger.error(f"Error processing frame for client {client_id}: {str(e)}")
+        item = {"client_id": client_id, "error": str(e)}
     finally:
-        # Clean up the future from pending_futures
-        for key, value in list(pending_futures.items()):
-            if value == client_id:
-                del pending_futures[key]
-                break
+        if block is not None:
+            shared_frames.release(block)
+        release_client_task(client_id)
 
-# Function to process the websocket responses queue
+    await deliver_websocket_response(item)
+
+# Function to process the queue and broadcast updates
 
 
-async def process_websocket_responses():
-    """Process the websocket responses queue and send responses to clients"""
+async def process_queue():
+    """Process the queue and broadcast updates to all connected clients"""
     while True:
+        item = await processing_results_queue.get()
         try:
-            # Check if there are any items in the queue
-            if not websocket_responses_queue.empty():
-                # Get the next item from the queue
-                item = websocket_responses_queue.get()
-                client_id = item["client_id"]
-
-                # Check if the client is still connected
-                if client_id not in active_connections:
-                    logger.info(f"Skipping response to disconnected client {client_id}")
-                    websocket_responses_queue.task_done()
-                    continue
+            # Process the item based on its type
+            if item.get("type") == "attendance_update":
+                # Broadcast the attendance update
+                await broadcast_attendance_update(item.get("data", []))
+        except Exception as e:
+            logger.error(f"Error processing queue: {str(e)}")
+        finally:
+            # Mark the task as done
+            processing_results_queue.task_done()
 
-                websocket = active_connections[client_id]
+def release_client_task(client_id):
+    """Decrement the pending tasks counter for a client"""
+    if client_id in client_pending_tasks:
+        client_pending_tasks[client_id] = max(0, client_pending_tasks[client_id] - 1)
 
-                # Check if this is an error response
-                if "error" in item:
-                    try:
-                        await websocket.send_json({"status": "processing_error", "message": item["error"]})
-                    except Exception as e:
-                        logger.error(
-                            f"Error sending error response to client {client_id}: {str(e)}")
-                        # Remove the client from active connections if it's causing errors
-                        if client_id in active_connections:
-                            del active_connections[client_id]
-                    continue
 
-                # Process the results
-                processed_users = item["processed_users"]
-                attendance_updates = item["attendance_updates"]
-
-                if not processed_users:
-                    if item["no_face_count"] > 0:
-                        # No face detected
-                        try:
-                            await websocket.send_json({"status": "no_face_detected"})
-                        except Exception as e:
-                            logger.error(
-                                f"Error sending no_face_detected response to client {client_id}: {str(e)}")
-                            if client_id in active_connections:
-                                del active_connections[client_id]
-                    else:
-                        # No matching users found
-                        try:
-                            await websocket.send_json({"status": "no_matching_users"})
-                        except Exception as e:
-                            logger.error(
-                                f"Error sending no_matching_users response to client {client_id}: {str(e)}")
-                            if client_id in active_connections:
-                                del active_connections[client_id]
-                else:
-                    # Send response with all processed users to the current client
-                    try:
-                        await websocket.send_json({
-                            "multiple_users": True,
-                            "users": processed_users
-                        })
-                    except Exception as e:
-                        logger.error(
-                            f"Error sending processed_users response to client {client_id}: {str(e)}")
-                        if client_id in active_connections:
-                            del active_connections[client_id]
+async def deliver_websocket_response(item):
+    """Send the result of a processed frame back to the client that sent it"""
+    client_id = item["client_id"]
 
-                    # Add attendance updates to the queue for broadcasting
-                    if attendance_updates:
-                        await broadcast_attendance_update(attendance_updates)
+    # Check if the client is still connected
+    connection = active_connections.get(client_id)
+    if connection is None:
+        logger.info(f"Skipping response to disconnected client {client_id}")
+        return
 
-                # Mark the task as done
-                websocket_responses_queue.task_done()
+    # Check if this is an error response
+    if "error" in item:
+        connection.send_json({"status": "processing_error", "message": item["error"]})
+        return
 
-            # Sleep for a short time to avoid busy waiting
-            await asyncio.sleep(0.1)
-        except Exception as e:
-            logger.error(f"Error processing websocket responses: {str(e)}")
-            # Sleep for a longer time if there was an error
-            await asyncio.sleep(1)
+    # Process the results
+    processed_users = item["processed_users"]
+    attendance_updates = item["attendance_updates"]
+
+    if not processed_users:
+        if item["no_face_count"] > 0:
+            # No face detected
+            connection.send_text(NO_FACE_DETECTED_FRAME)
+        else:
+            # No matching users found
+            connection.send_text(NO_MATCHING_USERS_FRAME)
+    else:
+        # Send response with all processed users to the current client
+        connection.send_json({
+            "multiple_users": True,
+            "users": processed_users
+        })
+
+        # Add attendance updates to the queue for broadcasting
+        if attendance_updates:
+            await broadcast_attendance_update(attendance_updates)
+
+
+def queue_from_thread(item):
+    """Queue an item for process_queue from a worker thread"""
+    event_loop.call_soon_threadsafe(processing_results_queue.put_nowait, item)
 
 # Start the queue processing task when the application starts
 
@@ -309,11 +712,28 @@ async def process_websocket_responses():
 @app.on_event("startup")
 async def startup_event():
     """Start the queue processing tasks when the application starts"""
+    # Cap the number of threads used for blocking calls (image decoding etc.)
+    global event_loop
+    event_loop = asyncio.get_running_loop()
+    event_loop.set_default_executor(decode_executor)
+    if face_recognition.uses_gpu:
+        # Threads share this process's models; warm them here rather than on
+        # the first client's frame (TensorRT may build its engines now)
+        await event_loop.run_in_executor(recognition_pool, warm_up_face_recognition)
+    else:
+        shared_frames.start()
     asyncio.create_task(process_queue())
-    asyncio.create_task(process_websocket_responses())
+    asyncio.create_task(frame_writer())
+    asyncio.create_task(frame_batcher.run())
     logger.info("Queue processing tasks started")
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Free the shared memory frame blocks"""
+    shared_frames.close()
+
+
 async def broadcast_attendance_update(attendance_data):
     """Broadcast attendance updates to all connected clients"""
     if not active_connections:
@@ -330,23 +750,27 @@ async def broadcast_attendance_update(attendance_data):
     logger.info(
         f"Broadcasting attendance update to {len(active_connections)} clients: {attendance_data}")
 
-    # Send to all connected clients
-    disconnected_clients = []
-    for client_id, websocket in active_connections.items():
-        try:
-            await websocket.send_json(message)
-            logger.debug(f"Successfully sent attendance update to client {client_id}")
-        except Exception as e:
-            logger.error(f"Error broadcasting to client {client_id}: {str(e)}")
-            # Mark for removal
-            disconnected_clients.append(client_id)
+    # Encode once and queue the same frame for every connected client
+    payload = dumps(message)
+    for connection in list(active_connections.values()):
+        connection.send_text(payload)
+
+
+def embed_registration_image(image_bytes: bytes):
+    """Decode a registration image and extract its face embedding in the process pool
+
+    Returns (embedding string, None) on success or (None, error message).
+    """
+    img = imdecode_for_detection(image_bytes, max(face_recognition.det_size))
+    if img is None:
+        return None, "Invalid image data"
+
+    embedding = face_recognition.get_embedding(img)
+    if embedding is None:
+        return None, "No face detected in image"
 
-    # Remove any disconnected clients
-    for client_id in disconnected_clients:
-        if client_id in active_connections:
-            del active_connections[client_id]
-            logger.info(
-                f"Removed disconnected client {client_id}. Total connections: {len(active_connections)}")
+    # Stored embeddings are unit length, so matching is a plain dot product
+    return face_recognition.embedding_to_str(embedding / np.linalg.norm(embedding)), None
 
 
 @app.post("/register")
@@ -356,16 +780,12 @@ async def register_user(
     image: UploadFile = File(...),
     db: Session = Depends(get_db)
 ):
-    # Read and decode image
+    # Decode the image and get the face embedding off the event loop
     contents = await image.read()
-    nparr = np.frombuffer(contents, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-
-    # Get face embedding
-    embedding = face_recognition.get_embedding(img)
+    embedding, error = await asyncio.get_running_loop().run_in_executor(
+        recognition_pool, embed_registration_image, contents)
     if embedding is None:
-        raise HTTPException(
-            status_code=400, detail="No face detected in image")
+        raise HTTPException(status_code=400, detail=error)
 
     # Check if user already exists
     existing_user = db.query(models.User).filter(
@@ -378,320 +798,430 @@ async def register_user(
     new_user = models.User(
         user_id=user_id,
         name=name,
-        embedding=face_recognition.embedding_to_str(embedding)
+        embedding=embedding
     )
     db.add(new_user)
     db.commit()
+    invalidate_user_cache()
 
     logger.info(f"User registered successfully: {user_id} ({name})")
     return {"message": "User registered successfully"}
 
 
-async def ping_client(websocket: WebSocket):
-    """Send periodic ping messages to keep the connection alive"""
-    try:
-        while True:
-            await asyncio.sleep(PING_INTERVAL)
-            try:
-                # Send a ping message
-                await websocket.send_json({"type": "ping"})
-                logger.debug("Sent ping to client")
-            except Exception as e:
-                logger.error(f"Error sending ping: {str(e)}")
-                break
-    except asyncio.CancelledError:
-        logger.info("Ping task cancelled")
-    except Exception as e:
-        logger.error(f"Ping task error: {str(e)}")
-
-
 @app.websocket("/ws/attendance")
-async def websocket_endpoint(websocket: WebSocket, db: Session = Depends(get_db)):
+async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     
     # Generate unique client ID
     client_id = str(uuid.uuid4())
-    active_connections[client_id] = websocket
+    connection = ClientConnection(client_id, websocket)
+    active_connections[client_id] = connection
     
     logger.info(
         f"New WebSocket connection {client_id}. Total connections: {len(active_connections)}")
 
     # Initialize pending tasks counter for this client
-    with client_pending_tasks_lock:
-        client_pending_tasks[client_id] = 0
+    client_pending_tasks[client_id] = 0
+
+    # Entry type applied to binary frames, taken from the client's last JSON message
+    stream_entry_type = "entry"
 
     try:
         while True:
-            data = await websocket.receive_json()
-
-            if data.get("type") == "get_attendance":
-                # Get all attendance records
-                attendance_records = db.query(models.Attendance).order_by(
-                    models.Attendance.timestamp.desc()).all()
-                await websocket.send_json({
-                    "type": "attendance_data",
-                    "data": [{
-                        "id": record.id,
-                        "user_id": record.user_id,
-                        "timestamp": record.timestamp.isoformat(),
-                        "confidence": record.confidence,
-                        "is_late": record.is_late
-                    } for record in attendance_records]
-                })
-
-            elif data.get("type") == "get_users":
-                # Get all users from cache
-                users = get_cached_users(db)
-                await websocket.send_json({
-                    "type": "user_data",
-                    "data": [{
-                        "user_id": user.user_id,
-                        "name": user.name,
-                        "created_at": user.created_at.isoformat()
-                    } for user in users]
-                })
-
-            elif data.get("type") == "delete_attendance":
-                # Delete attendance record
-                attendance_id = data.get("attendance_id")
-                if attendance_id:
-                    attendance = db.query(models.Attendance).filter(
-                        models.Attendance.id == attendance_id).first()
-                    if attendance:
-                        db.delete(attendance)
-                        db.commit()
-                        await broadcast_attendance_update([{
-                            "action": "delete",
-                            "user_id": attendance.user_id,
-                            "name": attendance.user.name,
-                            "timestamp": get_local_time().isoformat()
-                        }])
-
-            elif data.get("type") == "delete_user":
-                # Delete user
-                user_id = data.get("user_id")
-                if user_id:
-                    user = db.query(models.User).filter(
-                        models.User.user_id == user_id).first()
-                    if user:
-                        db.delete(user)
-                        db.commit()
-                        await broadcast_attendance_update([{
-                            "action": "delete_user",
-                            "user_id": user_id,
-                            "name": user.name,
-                            "timestamp": get_local_time().isoformat()
-                        }])
-
-            elif data.get("type") == "register_user":
-                # Register new user
-                user_id = data.get("user_id")
-                name = data.get("name")
-                image_data = data.get("image")
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
 
-                if not all([user_id, name, image_data]):
-                    await websocket.send_json({
-                        "status": "error",
-                        "message": "Missing required fields (user_id, name, or image)"
-                    })
+            if message.get("bytes") is not None:
+                # Binary frames are raw JPEG images, no base64 or JSON to decode
+                data = {"image": message["bytes"], "entry_type": stream_entry_type}
+            else:
+                data = orjson.loads(message["text"])
+                if "entry_type" in data:
+                    stream_entry_type = data["entry_type"]
+
+            if "image" in data and data.get("type") != "register_user":
+                # Drop frames arriving faster than MAX_FRAMES_PER_SECOND before doing any work
+                now = time.monotonic()
+                if now - last_frame_times.get(client_id, 0.0) < 1.0 / MAX_FRAMES_PER_SECOND:
                     continue
 
-                # Check if user already exists
-                existing_user = db.query(models.User).filter(
-                    models.User.user_id == user_id).first()
-                if existing_user:
-                    await websocket.send_json({
+                # Check if client has too many pending tasks
+                if client_pending_tasks.get(client_id, 0) >= MAX_CONCURRENT_TASKS_PER_CLIENT:
+                    connection.send_json({
                         "status": "error",
-                        "message": "User ID already registered"
+                        "message": "Too many pending tasks. Please wait."
                     })
                     continue
+                client_pending_tasks[client_id] = client_pending_tasks.get(client_id, 0) + 1
+                last_frame_times[client_id] = now
+
+                # Process image for face recognition
+                entry_type = data.get("entry_type", "entry")
+                task = asyncio.create_task(process_frame(client_id, data["image"], entry_type))
+                frame_tasks.add(task)
+                task.add_done_callback(frame_tasks.discard)
+                continue
+
+            # Timestamp used for any broadcast this message triggers
+            now_local = get_local_time()
 
-                try:
-                    # Process the image
-                    # Remove data URL prefix if present
-                    if "," in image_data:
-                        image_data = image_data.split(",")[1]
+            # Everything else gets a short-lived session so a pooled connection
+            # is only held while the message is being handled
+            db = next(get_db())
+            try:
+                if data.get("type") == "get_attendance":
+                    # Get all attendance records
+                    attendance_records = db.query(models.Attendance).order_by(
+                        models.Attendance.timestamp.desc()).all()
+                    connection.send_json({
+                        "type": "attendance_data",
+                        "data": [{
+                            "id": record.id,
+                            "user_id": record.user_id,
+                            "timestamp": record.timestamp.isoformat(),
+                            "confidence": record.confidence,
+                            "is_late": record.is_late
+                        } for record in attendance_records]
+                    })
 
-                    # Decode base64 to bytes
-                    image_bytes = base64.b64decode(image_data)
-                    nparr = np.frombuffer(image_bytes, np.uint8)
-                    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+                elif data.get("type") == "get_users":
+                    # Get all users from cache
+                    users = get_cached_users(db)
+                    connection.send_json({
+                        "type": "user_data",
+                        "data": [{
+                            "user_id": user.user_id,
+                            "name": user.name,
+                            "created_at": user.created_at.isoformat()
+                        } for user in users]
+                    })
 
-                    if img is None:
-                        await websocket.send_json({
+                elif data.get("type") == "delete_attendance":
+                    # Delete attendance record
+                    attendance_id = data.get("attendance_id")
+                    if attendance_id:
+                        # Primary key lookup, loading the user in the same query
+                        attendance = db.get(models.Attendance, attendance_id,
+                                            options=[joinedload(models.Attendance.user)])
+                        if attendance:
+                            # Read before the commit expires the deleted record
+                            user_id = attendance.user_id
+                            user_name = attendance.user.name if attendance.user else "Unknown"
+                            db.delete(attendance)
+                            db.commit()
+                            invalidate_recent_actions()
+                            await broadcast_attendance_update([{
+                                "action": "delete",
+                                "user_id": user_id,
+                                "name": user_name,
+                                "timestamp": now_local.isoformat()
+                            }])
+
+                elif data.get("type") == "delete_user":
+                    # Delete user
+                    user_id = data.get("user_id")
+                    if user_id:
+                        user = db.query(models.User).filter(
+                            models.User.user_id == user_id).first()
+                        if user:
+                            db.delete(user)
+                            db.commit()
+                            invalidate_user_cache()
+                            # Their attendance went with them
+                            invalidate_recent_actions()
+                            await broadcast_attendance_update([{
+                                "action": "delete_user",
+                                "user_id": user_id,
+                                "name": user.name,
+                                "timestamp": now_local.isoformat()
+                            }])
+
+                elif data.get("type") == "register_user":
+                    # Register new user
+                    user_id = data.get("user_id")
+                    name = data.get("name")
+                    image_data = data.get("image")
+
+                    if not all([user_id, name, image_data]):
+                        connection.send_json({
                             "status": "error",
-                            "message": "Invalid image data"
+                            "message": "Missing required fields (user_id, name, or image)"
                         })
                         continue
 
-                    # Get face embedding
-                    embedding = face_recognition.get_embedding(img)
-                    if embedding is None:
-                        await websocket.send_json({
+                    # Check if user already exists
+                    existing_user = db.query(models.User).filter(
+                        models.User.user_id == user_id).first()
+                    if existing_user:
+                        connection.send_json({
                             "status": "error",
-                            "message": "No face detected in image"
+                            "message": "User ID already registered"
                         })
                         continue
 
-                    # Create new user with embedding
-                    new_user = models.User(
-                        user_id=user_id,
-                        name=name,
-                        embedding=face_recognition.embedding_to_str(embedding)
-                    )
-                    db.add(new_user)
-                    db.commit()
-
-                    # Save the registration image
-                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-                    filename = f"register_{user_id}_{timestamp}.jpg"
-                    filepath = os.path.join(IMAGES_DIR, filename)
-                    # cv2.imwrite(filepath, img)
-                    logger.info(f"Saved registration image to {filepath}")
-
-                    # Broadcast user registration
-                    await broadcast_attendance_update([{
-                        "action": "register_user",
-                        "user_id": user_id,
-                        "name": name,
-                        "timestamp": get_local_time().isoformat()
-                    }])
-
-                    await websocket.send_json({
-                        "status": "success",
-                        "message": "User registered successfully"
-                    })
+                    try:
+                        # Process the image
+                        # Remove data URL prefix if present
+                        if "," in image_data:
+                            image_data = image_data.split(",")[1]
+
+                        # Decode base64 to bytes
+                        image_bytes = base64.b64decode(image_data)
+
+                        # Decode the image and get the face embedding off the event loop
+                        embedding, error = await asyncio.get_running_loop().run_in_executor(
+                            recognition_pool, embed_registration_image, image_bytes)
+                        if embedding is None:
+                            connection.send_json({
+                                "status": "error",
+                                "message": error
+                            })
+                            continue
+
+                        # Create new user with embedding
+                        new_user = models.User(
+                            user_id=user_id,
+                            name=name,
+                            embedding=embedding
+                        )
+                        db.add(new_user)
+                        db.commit()
+                        invalidate_user_cache()
 
-                except Exception as e:
-                    logger.error(f"Error registering user: {str(e)}")
-                    await websocket.send_json({
-                        "status": "error",
-                        "message": f"Error registering user: {str(e)}"
-                    })
+                        # Save the registration image
+                        save_frame(f"register_{user_id}", image_bytes)
 
-            elif "image" in data:
-                # Check if client has too many pending tasks
-                with client_pending_tasks_lock:
-                    if client_pending_tasks.get(client_id, 0) >= MAX_CONCURRENT_TASKS_PER_CLIENT:
-                        await websocket.send_json({
+                        # Broadcast user registration
+                        await broadcast_attendance_update([{
+                            "action": "register_user",
+                            "user_id": user_id,
+                            "name": name,
+                            "timestamp": now_local.isoformat()
+                        }])
+
+                        connection.send_json({
+                            "status": "success",
+                            "message": "User registered successfully"
+                        })
+
+                    except Exception as e:
+                        logger.error(f"Error registering user: {str(e)}")
+                        connection.send_json({
                             "status": "error",
-                            "message": "Too many pending tasks. Please wait."
+                            "message": f"Error registering user: {str(e)}"
                         })
-                        continue
-                    client_pending_tasks[client_id] += 1
 
-                # Process image for face recognition
-                entry_type = data.get("entry_type", "entry")
-
-                # Submit image processing to process pool
-                future = process_pool.submit(
-                    process_image_in_process,
-                    data["image"],
-                    entry_type,
-                    client_id
-                )
-
-                # Store the future with client_id
-                pending_futures[future] = client_id
-
-                # Add callback for when the future completes
-                future.add_done_callback(
-                    lambda f: handle_future_completion(f, client_id))
-
-            elif data.get("type") == "ping":
-                # Respond to ping
-                await websocket.send_json({"type": "pong"})
-
-            elif data.get("type") == "delete_early_exit_reason":
-                # Delete early exit reason
-                reason_id = data.get("reason_id")
-                if reason_id:
-                    reason = db.query(models.EarlyExitReason).filter(
-                        models.EarlyExitReason.id == reason_id).first()
-                    if reason:
-                        user = db.query(models.User).filter(
-                            models.User.user_id == reason.user_id).first()
-                        db.delete(reason)
-                        db.commit()
-                        await broadcast_attendance_update([{
-                            "action": "delete_early_exit_reason",
-                            "user_id": reason.user_id,
-                            "name": user.name if user else "Unknown",
-                            "attendance_id": reason.attendance_id,
-                            "reason_id": reason_id,
-                            "timestamp": get_local_time().isoformat()
-                        }])
+                elif data.get("type") == "delete_early_exit_reason":
+                    # Delete early exit reason
+                    reason_id = data.get("reason_id")
+                    if reason_id:
+                        reason = db.query(models.EarlyExitReason).filter(
+                            models.EarlyExitReason.id == reason_id).first()
+                        if reason:
+                            user = db.query(models.User).filter(
+                                models.User.user_id == reason.user_id).first()
+                            db.delete(reason)
+                            db.commit()
+                            await broadcast_attendance_update([{
+                                "action": "delete_early_exit_reason",
+                                "user_id": reason.user_id,
+                                "name": user.name if user else "Unknown",
+                                "attendance_id": reason.attendance_id,
+                                "reason_id": reason_id,
+                                "timestamp": now_local.isoformat()
+                            }])
+            finally:
+                db.close()
 
     except WebSocketDisconnect:
-        if client_id in active_connections:
-            del active_connections[client_id]
-        logger.info(
-            f"WebSocket connection {client_id} closed. Total connections: {len(active_connections)}")
+        logger.info(f"WebSocket client {client_id} disconnected")
     except Exception as e:
         logger.error(f"WebSocket error for client {client_id}: {str(e)}")
         try:
-            await websocket.send_json({
+            # Send directly; the writer task is cancelled below
+            await send_json_message(websocket, {
                 "status": "error",
                 "message": str(e)
             })
         except:
             pass
     finally:
-        try:
-            if client_id in active_connections:
-                del active_connections[client_id]
-            with client_pending_tasks_lock:
-                if client_id in client_pending_tasks:
-                    del client_pending_tasks[client_id]
-        except KeyError:
-            pass
+        connection.close()
+        active_connections.pop(client_id, None)
+        client_pending_tasks.pop(client_id, None)
+        last_frame_times.pop(client_id, None)
+        last_frame_results.forget(client_id)
         logger.info(
             f"WebSocket connection {client_id} closed. Total connections: {len(active_connections)}")
 
 
-def process_attendance_for_user(user, similarity, entry_type, db):
-    """Process attendance for a user with consistent duplicate checking"""
-    # Check if attendance already marked for today
-    today = get_local_date()
-    today_start = datetime.combine(today, datetime.min.time())
-    today_start = convert_to_local_time(today_start)
-    today_end = datetime.combine(today, datetime.max.time())
-    today_end = convert_to_local_time(today_end)
+def get_todays_attendance(db: Session, user_ids, now_local=None):
+    """Fetch today's attendance records for several users in one query
 
-    # Get any existing attendance record for today
-    existing_attendance = db.query(models.Attendance).filter(
-        models.Attendance.user_id == user.user_id,
+    Returns a dict of user_id -> attendance record, keeping the first record
+    per user like the single-user lookup did.
+    """
+    local_tz = get_cached_timezone()
+    current_time = now_local if now_local is not None else get_local_time(local_tz)
+    today = current_time.date()
+    today_start = convert_to_local_time(datetime.combine(today, datetime.min.time()), local_tz)
+    today_end = convert_to_local_time(datetime.combine(today, datetime.max.time()), local_tz)
+
+    records = db.query(models.Attendance).filter(
+        models.Attendance.user_id.in_(list(user_ids)),
         models.Attendance.timestamp >= today_start,
         models.Attendance.timestamp <= today_end
-    ).first()
+    ).all()
+
+    todays_attendance = {}
+    for record in records:
+        todays_attendance.setdefault(record.user_id, record)
+    return todays_attendance
+
+
+def get_office_hours_today(db: Session, now_local=None):
+    """Today's office login and logout times as local datetimes (None if not set)"""
+    local_tz = get_cached_timezone()
+    current_time = now_local if now_local is not None else get_local_time(local_tz)
+    today = current_time.date()
+
+    office_timing = get_cached_office_timing(db)
+    login_time = logout_time = None
+    if office_timing and office_timing.login_time:
+        login_time = convert_to_local_time(
+            datetime.combine(today, office_timing.login_time.time()), local_tz)
+    if office_timing and office_timing.logout_time:
+        logout_time = convert_to_local_time(
+            datetime.combine(today, office_timing.logout_time.time()), local_tz)
+    return OfficeTimingSettings(login_time, logout_time)
+
+
+def recall_recent_action(user, similarity, entry_type, today, generation):
+    """Reply for a user whose attendance was seen moments ago, or None if the database is needed
+
+    generation is the shared attendance generation read at the start of the
+    frame; entries remembered under another generation may be out of date.
+    """
+    global recent_actions_day
+    if today != recent_actions_day:
+        recent_actions.clear()
+        recent_actions_day = today
+
+    cached = recent_actions.get((user.user_id, today))
+    if cached is None:
+        return None
+    entry_time, exit_time, seen_at, cached_generation = cached
+    if cached_generation != generation:
+        return None
+    # An exit is final for the day; an open entry may be closed by another process
+    if exit_time is None and time.monotonic() - seen_at > RECENT_ACTION_TTL:
+        return None
+
+    if entry_type == "entry":
+        message = MSG_ENTRY_AFTER_EXIT if exit_time else MSG_ENTRY_ALREADY_MARKED
+        timestamp = entry_time
+    elif exit_time:
+        message = MSG_EXIT_ALREADY_MARKED
+        timestamp = exit_time
+    else:
+        # A pending exit has to be written
+        return None
+
+    return {
+        "message": message,
+        "user_id": user.user_id,
+        "name": user.name,
+        "timestamp": timestamp,
+        "similarity": similarity,
+        "entry_time": entry_time,
+        "exit_time": exit_time
+    }
+
+
+def attendance_states(todays_attendance):
+    """Entry/exit times per user, read before commit expires the records"""
+    return {
+        user_id: (attendance.timestamp.isoformat(),
+                  attendance.exit_time.isoformat() if attendance.exit_time else None)
+        for user_id, attendance in todays_attendance.items()
+    }
+
+
+def remember_recent_actions(states, today, generation):
+    """Record committed attendance states (from attendance_states) for recall_recent_action
+
+    Nothing is recorded if records were deleted since the states were read
+    under generation.
+    """
+    if shared_attendance_generation.value != generation:
+        return
+    now = time.monotonic()
+    for user_id, (entry_time, exit_time) in states.items():
+        recent_actions[(user_id, today)] = (entry_time, exit_time, now, generation)
+
+
+def invalidate_recent_actions():
+    """Forget recently seen attendance in every process"""
+    with shared_attendance_generation.get_lock():
+        shared_attendance_generation.value += 1
+    # Cached frame replies may say "already marked" for a deleted record
+    last_frame_results.clear()
+
+
+def process_attendance_for_user(user, similarity, entry_type, db, now_local=None, todays_attendance=None,
+                                office_hours=None):
+    """Process attendance for a user with consistent duplicate checking
+
+    now_local can be passed by callers processing several users at once so
+    the local time is only resolved once per request, todays_attendance
+    (from get_todays_attendance) so today's records are fetched in a single
+    query, and office_hours (from get_office_hours_today) so today's office
+    times are only converted once; new entries are added to
+    todays_attendance. New entries are returned as row
+    mappings in result["new_attendance"] for the caller to bulk insert, and
+    exits update the existing row in the session. Nothing is committed;
+    callers commit once after processing all matched users.
+    """
+    current_time = now_local if now_local is not None else get_local_time()
+
+    if office_hours is None:
+        office_hours = get_office_hours_today(db, current_time)
+
+    # Get any existing attendance record for today
+    if todays_attendance is None:
+        todays_attendance = get_todays_attendance(db, [user.user_id], current_time)
+    existing_attendance = todays_attendance.get(user.user_id)
 
     result = {
         "processed_user": None,
-        "attendance_update": None
+        "attendance_update": None,
+        "new_attendance": None
     }
 
     if entry_type == "entry":
         if existing_attendance:
+            entry_time = existing_attendance.timestamp.isoformat()
             # Check if there's already an entry without exit
             if not existing_attendance.exit_time:
                 result["processed_user"] = {
-                    "message": "Entry already marked for today",
+                    "message": MSG_ENTRY_ALREADY_MARKED,
                     "user_id": user.user_id,
                     "name": user.name,
-                    "timestamp": existing_attendance.timestamp.isoformat(),
+                    "timestamp": entry_time,
                     "similarity": similarity,
-                    "entry_time": existing_attendance.timestamp.isoformat(),
+                    "entry_time": entry_time,
                     "exit_time": None
                 }
             else:
                 # If there's an exit time, don't allow re-entry on same day
                 result["processed_user"] = {
-                    "message": "Cannot mark entry again for today after exit",
+                    "message": MSG_ENTRY_AFTER_EXIT,
                     "user_id": user.user_id,
                     "name": user.name,
-                    "timestamp": existing_attendance.timestamp.isoformat(),
+                    "timestamp": entry_time,
                     "similarity": similarity,
-                    "entry_time": existing_attendance.timestamp.isoformat(),
+                    "entry_time": entry_time,
                     "exit_time": existing_attendance.exit_time.isoformat()
                 }
             return result
@@ -700,15 +1230,10 @@ def process_attendance_for_user(user, similarity, entry_type, db):
         is_late = False
         late_message = None
         minutes_late = None
-        current_time = get_local_time()
         
-        # Get office timings
-        office_timing = db.query(models.OfficeTiming).first()
-        if office_timing and office_timing.login_time:
-            # Convert login_time to timezone-aware datetime for today
-            login_time = datetime.combine(today, office_timing.login_time.time())
-            login_time = convert_to_local_time(login_time)
-            
+        # Today's office login time
+        login_time = office_hours.login_time
+        if login_time:
             # Calculate the grace period end time (1 hour after login time)
             grace_period_end = login_time + timedelta(hours=1)
             
@@ -717,165 +1242,195 @@ def process_attendance_for_user(user, similarity, entry_type, db):
                 is_late = True
                 time_diff = current_time - login_time
                 minutes_late = int(time_diff.total_seconds() / 60)
-                late_message = f"Late arrival: {current_time.strftime('%H:%M')} ({minutes_late} minutes late, Office time: {login_time.strftime('%H:%M')}, Grace period: {grace_period_end.strftime('%H:%M')})"
+                late_message = f"Late arrival: {_hhmm(current_time)} ({minutes_late} minutes late, Office time: {_hhmm(login_time)}, Grace period: {_hhmm(grace_period_end)})"
 
-        new_attendance = models.Attendance(
-            user_id=user.user_id,
-            confidence=similarity,
-            is_late=is_late,
-            timestamp=current_time  # Ensure timezone-aware timestamp
-        )
-        db.add(new_attendance)
-        db.commit()
+        result["new_attendance"] = {
+            "user_id": user.user_id,
+            "confidence": similarity,
+            "is_late": is_late,
+            "timestamp": current_time  # Ensure timezone-aware timestamp
+        }
+        # Not added to the session; only used to catch a second match of the
+        # same user before the caller inserts the rows
+        new_attendance = models.Attendance(**result["new_attendance"])
+        todays_attendance[user.user_id] = new_attendance
 
         # Create message for on-time arrival
-        message = "Entry marked successfully"
+        message = MSG_ENTRY_MARKED
         if is_late:
             message += f" - {late_message}"
         else:
-            message += f" - On time (Office time: {login_time.strftime('%H:%M')}, Grace period until: {grace_period_end.strftime('%H:%M')})"
+            message += f" - On time (Office time: {_hhmm(login_time)}, Grace period until: {_hhmm(grace_period_end)})"
 
+        entry_time = current_time.isoformat()
         attendance_data = {
             "action": "entry",
             "user_id": user.user_id,
             "name": user.name,
-            "timestamp": new_attendance.timestamp.isoformat(),
+            "timestamp": entry_time,
             "similarity": similarity,
             "is_late": is_late,
             "late_message": late_message,
-            "entry_time": new_attendance.timestamp.isoformat(),
+            "entry_time": entry_time,
             "exit_time": None,
-            "minutes_late": minutes_late
+            "minutes_late": minutes_late,
+            "message": message
         }
 
-        result["processed_user"] = {**attendance_data, "message": message}
+        # The reply and the broadcast share one dict
+        result["processed_user"] = attendance_data
         result["attendance_update"] = attendance_data
 
     else:  # exit
         if not existing_attendance:
             result["processed_user"] = {
-                "message": "No entry record found for today",
+                "message": MSG_NO_ENTRY_FOUND,
                 "user_id": user.user_id,
                 "name": user.name,
                 "similarity": similarity
             }
             return result
         elif existing_attendance.exit_time:
+            exit_time = existing_attendance.exit_time.isoformat()
             result["processed_user"] = {
-                "message": "Exit already marked for today",
+                "message": MSG_EXIT_ALREADY_MARKED,
                 "user_id": user.user_id,
                 "name": user.name,
-                "timestamp": existing_attendance.exit_time.isoformat(),
+                "timestamp": exit_time,
                 "similarity": similarity,
                 "entry_time": existing_attendance.timestamp.isoformat(),
-                "exit_time": existing_attendance.exit_time.isoformat()
+                "exit_time": exit_time
             }
             return result
 
         # Process exit for users with existing entry but no exit
         is_early_exit = False
         early_exit_message = None
-        current_time = get_local_time()
         
-        # Get office timings
-        office_timing = db.query(models.OfficeTiming).first()
-        if office_timing and office_timing.logout_time:
-            # Convert logout_time to timezone-aware datetime for today
-            logout_time = datetime.combine(today, office_timing.logout_time.time())
-            logout_time = convert_to_local_time(logout_time)
-            
+        # Today's office logout time
+        logout_time = office_hours.logout_time
+        if logout_time:
             if current_time < logout_time:
                 is_early_exit = True
-                early_exit_message = f"Early exit: {current_time.strftime('%H:%M')} (Office time: {logout_time.strftime('%H:%M')})"
+                early_exit_message = f"Early exit: {_hhmm(current_time)} (Office time: {_hhmm(logout_time)})"
 
         # Update the existing attendance record with exit time
         existing_attendance.exit_time = current_time
         existing_attendance.is_early_exit = is_early_exit
-        db.commit()
 
+        exit_time = current_time.isoformat()
         attendance_data = {
             "action": "exit",
             "user_id": user.user_id,
             "name": user.name,
-            "timestamp": current_time.isoformat(),
+            "timestamp": exit_time,
             "similarity": similarity,
             "is_early_exit": is_early_exit,
             "early_exit_message": early_exit_message,
             "attendance_id": existing_attendance.id,
             "entry_time": existing_attendance.timestamp.isoformat(),
-            "exit_time": current_time.isoformat()
+            "exit_time": exit_time,
+            "message": MSG_EXIT_RECORDED + (f" - {early_exit_message}" if early_exit_message else "")
         }
 
-        result["processed_user"] = {
-            **attendance_data,
-            "message": "Exit recorded successfully" + (f" - {early_exit_message}" if early_exit_message else "")
-        }
+        # The reply and the broadcast share one dict
+        result["processed_user"] = attendance_data
         result["attendance_update"] = attendance_data
 
     return result
 
-# Update process_image_in_process to use the shared function
-def process_image_in_process(image_data: str, entry_type: str, client_id: str):
-    """Process image in a separate process"""
-    db = next(get_db())
-    try:
-        # Remove data URL prefix if present
-        if "," in image_data:
-            image_data = image_data.split(",")[1]
+def record_matches(db: Session, matches, entry_type: str):
+    """Record entry/exit for the users matched in one frame or request
 
-        # Decode base64 to bytes
-        image_bytes = base64.b64decode(image_data)
+    Users seen moments ago are answered from the recent-actions cache;
+    today's records are only queried for the rest, and all their changes
+    are committed at once. Returns (processed_users, attendance_updates).
+    """
+    processed_users = []
+    attendance_updates = []
+    new_attendance_rows = []
+
+    # Resolve the local time once, and today's records only for users that
+    # weren't seen moments ago
+    now_local = get_local_time()
+    today = now_local.date()
+    generation = shared_attendance_generation.value
+    recalled = [recall_recent_action(match['user'], match['similarity'], entry_type, today, generation)
+                for match in matches]
+    pending_user_ids = {match['user'].user_id
+                        for match, reply in zip(matches, recalled) if reply is None}
+    if not pending_user_ids:
+        return recalled, attendance_updates
+
+    todays_attendance = get_todays_attendance(db, pending_user_ids, now_local)
+    office_hours = get_office_hours_today(db, now_local)
+
+    for match, reply in zip(matches, recalled):
+        if reply is not None:
+            processed_users.append(reply)
+            continue
 
-        # Convert to numpy array
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        # Process attendance using shared function
+        result = process_attendance_for_user(
+            match['user'], match['similarity'], entry_type, db, now_local, todays_attendance, office_hours)
 
-        if img is None:
-            return [], [], {}, 0
+        if result["processed_user"]:
+            processed_users.append(result["processed_user"])
+
+        if result["attendance_update"]:
+            attendance_updates.append(result["attendance_update"])
+
+        if result["new_attendance"]:
+            new_attendance_rows.append(result["new_attendance"])
+
+    # Insert new entries and commit all attendance changes at once
+    if new_attendance_rows:
+        db.bulk_insert_mappings(models.Attendance, new_attendance_rows)
+    states = attendance_states(todays_attendance)
+    db.commit()
+    remember_recent_actions(states, today, generation)
 
+    return processed_users, attendance_updates
+
+# Update process_image_in_process to use the shared function
+def process_image_in_process(frame_name: str, shape, entry_type: str, client_id: str):
+    """Process a frame from shared memory in a separate process"""
+    return recognize_frame(read_shared_frame(frame_name, shape), entry_type, client_id)
+
+def recognize_frame(img, entry_type: str, client_id: str):
+    """Recognize the faces in a frame and record their attendance"""
+    db = recognition_session()
+    try:
         # Get all face embeddings from the image
         face_embeddings = face_recognition.get_embeddings(img)
         if not face_embeddings:
             return [], [], {}, 1
 
-        # Get all users from the cache
-        users = get_cached_users(db)
+        # Get all users and their embedding index from the cache
+        users, embedding_index = get_cached_user_embeddings()
 
         # Find matches for all detected faces
         matches = face_recognition.find_matches_for_embeddings(
-            face_embeddings, users)
+            face_embeddings, users, embedding_index=embedding_index)
 
         if not matches:
             return [], [], {}, 0
 
-        # Process each matched user
-        processed_users = []
-        attendance_updates = []
-        last_recognized_users = {}
-
-        for match in matches:
-            user = match['user']
-            similarity = match['similarity']
+        # Update last recognized users (ids only, ORM objects aren't
+        # worth pickling back to the main process)
+        last_recognized_users = {
+            match['user'].user_id: {'name': match['user'].name, 'similarity': match['similarity']}
+            for match in matches
+        }
 
-            # Update last recognized users
-            last_recognized_users[user.user_id] = {
-                'user': user,
-                'similarity': similarity
-            }
-
-            # Process attendance using shared function
-            result = process_attendance_for_user(user, similarity, entry_type, db)
-            
-            if result["processed_user"]:
-                processed_users.append(result["processed_user"])
-            
-            if result["attendance_update"]:
-                attendance_updates.append(result["attendance_update"])
+        processed_users, attendance_updates = record_matches(db, matches, entry_type)
 
         return processed_users, attendance_updates, last_recognized_users, 0
 
     except Exception as e:
         logger.error(f"Error processing image in process: {str(e)}")
+        # Drop this frame's partial attendance changes as a whole
+        db.rollback()
         return [], [], {}, 0
     finally:
         db.close()
@@ -888,23 +1443,25 @@ async def mark_attendance(
     db: Session = Depends(get_db)
 ):
     """Mark attendance for a user based on face recognition"""
-    # Read and decode image
+    # Read, decode and downscale the image
     contents = await image.read()
-    nparr = np.frombuffer(contents, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    img = await asyncio.to_thread(decode_image, contents)
+
+    # Save the frame (written in the background, contents are already JPEG)
+    save_frame("attendance", contents)
 
     # Get all face embeddings from the image
-    face_embeddings = face_recognition.get_embeddings(img)
+    face_embeddings = await frame_batcher.submit(img)
     if not face_embeddings:
         raise HTTPException(
             status_code=400, detail="No face detected in image")
 
-    # Get all users from the database
-    users = db.query(models.User).all()
+    # Get all users and their embedding index from the cache
+    users, embedding_index = await asyncio.to_thread(get_cached_user_embeddings)
 
     # Find matches for all detected faces
     matches = face_recognition.find_matches_for_embeddings(
-        face_embeddings, users)
+        face_embeddings, users, embedding_index=embedding_index)
 
     if not matches:
         raise HTTPException(
@@ -912,22 +1469,7 @@ async def mark_attendance(
             detail="No matching users found in the image"
         )
 
-    # Process each matched user
-    processed_users = []
-    attendance_updates = []
-
-    for match in matches:
-        user = match['user']
-        similarity = match['similarity']
-
-        # Process attendance using shared function
-        result = process_attendance_for_user(user, similarity, entry_type, db)
-        
-        if result["processed_user"]:
-            processed_users.append(result["processed_user"])
-        
-        if result["attendance_update"]:
-            attendance_updates.append(result["attendance_update"])
+    processed_users, attendance_updates = record_matches(db, matches, entry_type)
 
     # Broadcast attendance updates
     if attendance_updates:
@@ -946,30 +1488,25 @@ async def debug_face_recognition(
     db: Session = Depends(get_db)
 ):
     """Debug endpoint for face recognition"""
-    # Read and decode image
+    # Read, decode and downscale the image
     contents = await image.read()
-    nparr = np.frombuffer(contents, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    img = await asyncio.to_thread(decode_image, contents)
 
-    # Save the frame
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-    filename = f"debug_{timestamp}.jpg"
-    filepath = os.path.join(IMAGES_DIR, filename)
-    # cv2.imwrite(filepath, img)
-    logger.info(f"Saved debug frame to {filepath}")
+    # Save the frame (written in the background, contents are already JPEG)
+    save_frame("debug", contents)
 
     # Get all face embeddings from the image
-    face_embeddings = face_recognition.get_embeddings(img)
+    face_embeddings = await frame_batcher.submit(img)
     if not face_embeddings:
         raise HTTPException(
             status_code=400, detail="No face detected in image")
 
-    # Get all users from the database
-    users = db.query(models.User).all()
+    # Get all users and their embedding index from the cache
+    users, embedding_index = await asyncio.to_thread(get_cached_user_embeddings)
 
     # Find matches for all detected faces
     matches = face_recognition.find_matches_for_embeddings(
-        face_embeddings, users)
+        face_embeddings, users, embedding_index=embedding_index)
 
     if not matches:
         raise HTTPException(
@@ -1005,8 +1542,8 @@ async def set_office_timings(
     """Set office timings"""
     try:
         # Parse times
-        login_dt = datetime.strptime(login_time, "%H:%M").time()
-        logout_dt = datetime.strptime(logout_time, "%H:%M").time()
+        login_dt = _parse_hhmm(login_time)
+        logout_dt = _parse_hhmm(logout_time)
         
         # Get current date in local timezone
         today = get_local_date()
@@ -1032,6 +1569,7 @@ async def set_office_timings(
             )
             db.add(new_timing)
             db.commit()
+        invalidate_office_timing_cache()
         
         return {"message": "Office timings updated successfully"}
     except Exception as e:
@@ -1046,8 +1584,8 @@ def get_office_timings(db: Session = Depends(get_db)):
         return {"login_time": None, "logout_time": None}
     
     return {
-        "login_time": timing.login_time.strftime("%H:%M") if timing.login_time else None,
-        "logout_time": timing.logout_time.strftime("%H:%M") if timing.logout_time else None
+        "login_time": _hhmm(timing.login_time) if timing.login_time else None,
+        "logout_time": _hhmm(timing.logout_time) if timing.logout_time else None
     }
 
 @app.get("/timezone")
@@ -1075,6 +1613,7 @@ async def set_timezone(timezone: str = Form(...), db: Session = Depends(get_db))
             db.add(timezone_config)
         
         db.commit()
+        invalidate_timezone_cache()
         return {"message": "Timezone updated successfully", "timezone": timezone}
     except pytz.exceptions.UnknownTimeZoneError:
         raise HTTPException(status_code=400, detail="Invalid timezone")
@@ -1082,63 +1621,108 @@ async def set_timezone(timezone: str = Form(...), db: Session = Depends(get_db))
         logger.error(f"Error setting timezone: {str(e)}")
         raise HTTPException(status_code=500, detail="Failed to update timezone")
 
+# The timezone list never changes, so it is encoded once at import
+ALL_TIMEZONES_JSON = orjson.dumps({"timezones": list(pytz.all_timezones)})
+
 @app.get("/timezones")
 def get_available_timezones():
     """Get list of all available timezones"""
-    return {"timezones": pytz.all_timezones}
+    return Response(content=ALL_TIMEZONES_JSON, media_type="application/json")
 
 @app.get("/users")
 def get_users(db: Session = Depends(get_db)):
     """Get all registered users"""
-    users = db.query(models.User).all()
-    return [
+    # Served from the user cache, which is invalidated whenever users change
+    users = get_cached_users(db)
+    # Returned as a response directly so orjson formats the datetimes, skipping jsonable_encoder
+    return ORJSONResponse([
         {
             "user_id": user.user_id,
             "name": user.name,
-            "created_at": user.created_at.isoformat() if user.created_at else None
+            "created_at": user.created_at
         }
         for user in users
-    ]
+    ])
+
+# Rows fetched per round trip while streaming the attendance listing
+ATTENDANCE_STREAM_BATCH_SIZE = 500
+
+def stream_attendance_records(limit: Optional[int] = None, before_id: Optional[int] = None):
+    """Yield attendance records, newest first, as a JSON array one row at a time
+
+    limit and before_id page through the history: before_id is the id of the
+    last record of the previous page. Without them every record is sent.
+    """
+    # The session is owned by the generator, so it stays open until the last row is sent
+    db = next(get_db())
+    try:
+        # Plain column rows: no ORM objects or identity map for a read-only listing
+        query = db.query(
+            models.Attendance.id,
+            models.Attendance.user_id,
+            models.User.name,
+            models.Attendance.timestamp,
+            models.Attendance.exit_time,
+            models.Attendance.confidence,
+            models.Attendance.is_late,
+            models.Attendance.is_early_exit
+        ).outerjoin(models.Attendance.user).order_by(
+            models.Attendance.timestamp.desc(), models.Attendance.id.desc())
+        if before_id is not None:
+            # Keyset pagination: continue right after the cursor record
+            cursor = db.query(models.Attendance.timestamp).filter(
+                models.Attendance.id == before_id).scalar()
+            if cursor is None:
+                query = query.filter(false())
+            else:
+                query = query.filter(or_(
+                    models.Attendance.timestamp < cursor,
+                    and_(models.Attendance.timestamp == cursor, models.Attendance.id < before_id)))
+        if limit is not None:
+            query = query.limit(limit)
+        attendances = query.yield_per(ATTENDANCE_STREAM_BATCH_SIZE)
+        yield b"["
+        for i, att in enumerate(attendances):
+            record = {
+                "id": att.id,
+                "user_id": att.user_id,
+                "name": att.name if att.name is not None else "Unknown User",
+                "entry_time": att.timestamp,
+                "exit_time": att.exit_time,
+                "confidence": att.confidence,
+                "is_late": att.is_late,
+                "is_early_exit": att.is_early_exit,
+                "late_message": f"Late arrival: {_hhmm(att.timestamp)}" if att.is_late else None,
+                "early_exit_message": f"Early exit: {_hhmm(att.exit_time)}" if att.is_early_exit else None
+            }
+            yield (b"," if i else b"") + orjson.dumps(record, option=orjson.OPT_SERIALIZE_NUMPY)
+        yield b"]"
+    finally:
+        db.close()
 
 @app.get("/attendance")
-def get_attendance(db: Session = Depends(get_db)):
-    """Get all attendance records"""
-    attendances = db.query(models.Attendance).order_by(
-        models.Attendance.timestamp.desc()).all()
-    return [
-        {
-            "id": att.id,
-            "user_id": att.user_id,
-            "name": att.user.name if att.user else "Unknown User",
-            "entry_time": att.timestamp.isoformat() if att.timestamp else None,
-            "exit_time": att.exit_time.isoformat() if att.exit_time else None,
-            "confidence": att.confidence,
-            "is_late": att.is_late,
-            "is_early_exit": att.is_early_exit,
-            "late_message": f"Late arrival: {att.timestamp.strftime('%H:%M')}" if att.is_late else None,
-            "early_exit_message": f"Early exit: {att.exit_time.strftime('%H:%M')}" if att.is_early_exit else None
-        }
-        for att in attendances
-    ]
+def get_attendance(limit: Optional[int] = None, before_id: Optional[int] = None):
+    """Get attendance records, newest first (all of them unless paged with limit/before_id)"""
+    return StreamingResponse(stream_attendance_records(limit, before_id), media_type="application/json")
 
 @app.delete("/attendance/{attendance_id}")
 def delete_attendance(attendance_id: int, db: Session = Depends(get_db)):
     """Delete an attendance record"""
-    # Find the attendance record
-    attendance = db.query(models.Attendance).filter(
-        models.Attendance.id == attendance_id).first()
+    # Find the attendance record (primary key lookup) along with its user
+    attendance = db.get(models.Attendance, attendance_id,
+                        options=[joinedload(models.Attendance.user)])
     if not attendance:
         raise HTTPException(
             status_code=404, detail="Attendance record not found")
 
     # Store user info before deletion for broadcasting
     user_id = attendance.user_id
-    user = db.query(models.User).filter(models.User.user_id == user_id).first()
-    user_name = user.name if user else "Unknown"
+    user_name = attendance.user.name if attendance.user else "Unknown"
 
     # Delete the attendance record
     db.delete(attendance)
     db.commit()
+    invalidate_recent_actions()
 
     # Create attendance update for broadcasting
     attendance_update = {
@@ -1150,7 +1734,7 @@ def delete_attendance(attendance_id: int, db: Session = Depends(get_db)):
     }
 
     # Add the update to the processing results queue
-    processing_results_queue.put({
+    queue_from_thread({
         "type": "attendance_update",
         "data": [attendance_update]
     })
@@ -1169,6 +1753,9 @@ def delete_user(user_id: str, db: Session = Depends(get_db)):
     # Delete the user
     db.delete(user)
     db.commit()
+    invalidate_user_cache()
+    # Their attendance went with them
+    invalidate_recent_actions()
 
     logger.info(f"User deleted successfully: {user_id}")
     return {"message": "User deleted successfully"}
@@ -1176,20 +1763,23 @@ def delete_user(user_id: str, db: Session = Depends(get_db)):
 @app.get("/early-exit-reasons")
 def get_early_exit_reasons(db: Session = Depends(get_db)):
     """Get all early exit reasons"""
-    reasons = db.query(models.EarlyExitReason).order_by(
+    reasons = db.query(models.EarlyExitReason).options(
+        joinedload(models.EarlyExitReason.user)
+    ).order_by(
         models.EarlyExitReason.timestamp.desc()
     ).all()
-    return [
+    # Returned as a response directly so orjson formats the datetimes, skipping jsonable_encoder
+    return ORJSONResponse([
         {
             "id": reason.id,
             "user_id": reason.user_id,
             "user_name": reason.user.name,
             "attendance_id": reason.attendance_id,
             "reason": reason.reason,
-            "timestamp": reason.timestamp.isoformat()
+            "timestamp": reason.timestamp
         }
         for reason in reasons
-    ]
+    ])
 
 def initialize_back4app():
     """Initialize Back4App database with default data"""
@@ -1234,6 +1824,4 @@ def initialize_back4app():
 async def startup_event():
     """Initialize the application on startup"""
     initialize_back4app()
-    # Start the WebSocket response processing task
-    asyncio.create_task(process_websocket_responses())
     logger.info("Application startup completed")
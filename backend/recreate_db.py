@@ -1,23 +1,42 @@
 from sqlalchemy import create_engine
-from models import Base
+from sqlalchemy.orm import Session
+from models import Base, User
 import os
+import sys
 
 # Get the database URL from environment variable or use default
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./attendance.db")
 
-def recreate_database():
+def recreate_database(engine=None):
     # Create engine
-    engine = create_engine(DATABASE_URL)
-    
-    # Drop all tables
-    print("Dropping all tables...")
-    Base.metadata.drop_all(engine)
-    
-    # Create all tables
-    print("Creating new tables...")
-    Base.metadata.create_all(engine)
-    
+    engine = engine or create_engine(DATABASE_URL)
+
+    # Drop and create all tables in one transaction; after the drop no
+    # table exists, so create_all can skip its per-table existence checks
+    with engine.begin() as conn:
+        print("Dropping all tables...")
+        Base.metadata.drop_all(conn)
+
+        print("Creating new tables...")
+        Base.metadata.create_all(conn, checkfirst=False)
+
     print("Database recreated successfully!")
 
+def migrate_embeddings():
+    # Rewrite embeddings stored as JSON lists in the compact base64 float32 format
+    # (imported here so recreating the schema doesn't load the face models)
+    from face_utils import migrate_embedding
+
+    engine = create_engine(DATABASE_URL)
+    with Session(engine) as db:
+        users = db.query(User).filter(User.embedding.like("[%")).all()
+        for user in users:
+            user.embedding = migrate_embedding(user.embedding)
+        db.commit()
+    print(f"Migrated {len(users)} embeddings")
+
 if __name__ == "__main__":
-    recreate_database() 
\ No newline at end of file
+    if sys.argv[1:] == ["--migrate-embeddings"]:
+        migrate_embeddings()
+    else:
+        recreate_database() 
\ No newline at end of file
@@ -1,16 +1,11 @@
-from models import Base
 from database import engine, get_db
+from recreate_db import recreate_database
 from sqlalchemy.orm import Session
 from sqlalchemy import text
 
 def reset_db():
-    # Drop all tables
-    Base.metadata.drop_all(bind=engine)
-    print("All tables dropped successfully!")
-
-    # Create all tables
-    Base.metadata.create_all(bind=engine)
-    print("Database tables created successfully!")
+    # Drop and create all tables
+    recreate_database(engine)
 
     # Create a session to verify tables
     db = next(get_db())
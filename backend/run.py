@@ -1,4 +1,10 @@
 import uvicorn
 
+# WebSocket keepalive is done with protocol-level ping frames by uvicorn
+# itself (seconds)
+WS_PING_INTERVAL = 30
+WS_PING_TIMEOUT = 60
+
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True) 
\ No newline at end of file
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True,
+                ws_ping_interval=WS_PING_INTERVAL, ws_ping_timeout=WS_PING_TIMEOUT) 
\ No newline at end of file
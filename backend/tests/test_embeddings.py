@@ -0,0 +1,63 @@
+import base64
+import json
+
+import numpy as np
+import pytest
+
+face_utils = pytest.importorskip("face_utils")
+
+
+@pytest.fixture
+def embedding():
+    return np.random.default_rng(0).standard_normal(512).astype(np.float32)
+
+
+def test_embedding_round_trips_as_base64_float32(embedding):
+    stored = face_utils.encode_embedding(embedding)
+    assert len(base64.b64decode(stored)) == 512 * 4
+    decoded = face_utils.decode_embedding(stored)
+    assert decoded.dtype == np.float32
+    assert np.array_equal(decoded, embedding)
+
+
+def test_float64_embeddings_are_stored_as_float32(embedding):
+    stored = face_utils.encode_embedding(embedding.astype(np.float64))
+    assert np.array_equal(face_utils.decode_embedding(stored), embedding)
+
+
+def test_decodes_embeddings_stored_as_json_lists(embedding):
+    decoded = face_utils.decode_embedding(json.dumps(embedding.tolist()))
+    assert decoded.dtype == np.float32
+    assert np.array_equal(decoded, embedding)
+
+
+def test_migration_is_idempotent(embedding):
+    migrated = face_utils.migrate_embedding(json.dumps(embedding.tolist()))
+    assert migrated == face_utils.encode_embedding(embedding)
+    assert face_utils.migrate_embedding(migrated) == migrated
+
+
+def test_migrate_embeddings_rewrites_only_json_rows(tmp_path, monkeypatch, embedding):
+    pytest.importorskip("sqlalchemy")
+    pytest.importorskip("models")
+    recreate_db = pytest.importorskip("recreate_db")
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session
+
+    url = f"sqlite:///{tmp_path / 'attendance.db'}"
+    monkeypatch.setattr(recreate_db, "DATABASE_URL", url)
+    engine = create_engine(url)
+    recreate_db.recreate_database(engine)
+    with Session(engine) as db:
+        db.add_all([
+            recreate_db.User(user_id="old", name="Old", embedding=json.dumps(embedding.tolist())),
+            recreate_db.User(user_id="new", name="New", embedding=face_utils.encode_embedding(embedding)),
+        ])
+        db.commit()
+
+    recreate_db.migrate_embeddings()
+    recreate_db.migrate_embeddings()
+
+    with Session(engine) as db:
+        stored = {user.user_id: user.embedding for user in db.query(recreate_db.User)}
+    assert stored == {"old": face_utils.encode_embedding(embedding), "new": face_utils.encode_embedding(embedding)}
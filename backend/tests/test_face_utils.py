@@ -0,0 +1,51 @@
+import threading
+import time
+
+import pytest
+
+face_utils = pytest.importorskip("face_utils")
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_unchanged_generation_reuses_index():
+    built = []
+
+    def load():
+        built.append(object())
+        return built[-1]
+
+    cache = face_utils.EmbeddingIndexCache(load)
+    first = cache.get(0)
+    assert cache.get(0) is first
+    assert cache.get(0) is first
+    assert len(built) == 1
+
+
+def test_new_generation_is_built_in_the_background():
+    release = threading.Event()
+    built = []
+
+    def load():
+        if built:
+            assert release.wait(5)
+        built.append(object())
+        return built[-1]
+
+    cache = face_utils.EmbeddingIndexCache(load)
+    first = cache.get(0)
+
+    # Callers keep searching the previous index while the new one is built,
+    # and asking again doesn't start a second rebuild
+    assert cache.get(1) is first
+    assert cache.get(1) is first
+    release.set()
+    wait_for(lambda: cache.generation == 1)
+
+    assert cache.get(1) is built[1]
+    assert len(built) == 2
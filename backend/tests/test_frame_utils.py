@@ -0,0 +1,125 @@
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip("cv2")
+frame_utils = pytest.importorskip("frame_utils")
+
+
+@pytest.fixture
+def frame():
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 256, (480, 640, 3), dtype=np.uint8)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(frame_utils.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_difference_hash_is_64_bits_and_stable(frame):
+    frame_hash = frame_utils.difference_hash(frame)
+    assert 0 <= frame_hash < 1 << 64
+    assert frame_utils.difference_hash(frame.copy()) == frame_hash
+
+
+def test_difference_hash_tolerates_noise_but_not_a_new_scene(frame):
+    rng = np.random.default_rng(1)
+    noisy = np.clip(frame.astype(np.int16) + rng.integers(-2, 3, frame.shape), 0, 255).astype(np.uint8)
+    other = rng.integers(0, 256, frame.shape, dtype=np.uint8)
+    frame_hash = frame_utils.difference_hash(frame)
+    assert frame_utils.hamming_distance(frame_hash, frame_utils.difference_hash(noisy)) <= 3
+    assert frame_utils.hamming_distance(frame_hash, frame_utils.difference_hash(other)) > 3
+
+
+def test_hamming_distance():
+    assert frame_utils.hamming_distance(0b1011, 0b1011) == 0
+    assert frame_utils.hamming_distance(0b1011, 0b0010) == 2
+    assert frame_utils.hamming_distance(0, (1 << 64) - 1) == 64
+
+
+def test_near_duplicate_frame_replays_reply(clock):
+    cache = frame_utils.FrameResultCache(max_distance=3, ttl=5.0)
+    item = {"client_id": "a"}
+    cache.remember("a", "entry", 0b0000, item)
+    assert cache.recall("a", "entry", 0b0111) is item
+    assert cache.recall("a", "entry", 0b1111) is None
+    assert cache.recall("a", "exit", 0b0000) is None
+    assert cache.recall("b", "entry", 0b0000) is None
+
+
+def test_reply_expires_after_ttl(clock):
+    cache = frame_utils.FrameResultCache(max_distance=3, ttl=5.0)
+    item = {"client_id": "a"}
+    cache.remember("a", "entry", 42, item)
+    clock[0] += 5.0
+    assert cache.recall("a", "entry", 42) is item
+    clock[0] += 0.1
+    assert cache.recall("a", "entry", 42) is None
+
+
+def test_forget_and_clear(clock):
+    cache = frame_utils.FrameResultCache(max_distance=3, ttl=5.0)
+    cache.remember("a", "entry", 1, {})
+    cache.remember("b", "entry", 1, {})
+    cache.forget("a")
+    assert cache.recall("a", "entry", 1) is None
+    assert cache.recall("b", "entry", 1) is not None
+    cache.clear()
+    assert cache.recall("b", "entry", 1) is None
+
+
+
+def encode_jpeg(height, width, progressive=False):
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    ok, data = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_PROGRESSIVE, int(progressive)])
+    assert ok
+    return data.tobytes()
+
+
+@pytest.mark.parametrize("progressive", [False, True])
+def test_jpeg_size_reads_the_frame_header(progressive):
+    data = encode_jpeg(480, 640, progressive)
+    assert frame_utils.jpeg_size(data) == (480, 640)
+
+
+def test_jpeg_size_skips_fill_bytes_and_standalone_markers():
+    data = encode_jpeg(120, 200)
+    # Fill bytes before the next marker, then an RST0 and a TEM marker
+    # (neither has a length field)
+    data = data[:2] + b"\xff\xff\xff" + b"\xff\xd0" + b"\xff\x01" + data[2:]
+    assert frame_utils.jpeg_size(data) == (120, 200)
+
+
+def test_jpeg_size_rejects_truncated_and_other_data():
+    data = encode_jpeg(480, 640)
+    sof = next(i for i in range(2, len(data) - 1)
+               if data[i] == 0xFF and data[i + 1] in frame_utils.JPEG_SOF_MARKERS)
+    assert frame_utils.jpeg_size(data[:sof + 6]) is None
+    assert frame_utils.jpeg_size(data[:3]) is None
+    assert frame_utils.jpeg_size(b"") is None
+    assert frame_utils.jpeg_size(b"\x89PNG\r\n\x1a\n") is None
+    # Scan data before any frame header
+    assert frame_utils.jpeg_size(b"\xff\xd8\xff\xda\x00\x08") is None
+
+
+@pytest.mark.parametrize("size, flags", [
+    ((3000, 5200), cv2.IMREAD_REDUCED_COLOR_8),
+    ((1920, 2560), cv2.IMREAD_REDUCED_COLOR_4),
+    ((1080, 1920), cv2.IMREAD_REDUCED_COLOR_2),
+    ((960, 1280), cv2.IMREAD_REDUCED_COLOR_2),
+    ((720, 1279), cv2.IMREAD_COLOR),
+    ((480, 640), cv2.IMREAD_COLOR),
+    (None, cv2.IMREAD_COLOR),
+])
+def test_decode_flags_keep_the_long_side_at_detector_size(size, flags):
+    assert frame_utils.decode_flags(size, 640) == flags
+
+
+def test_imdecode_for_detection_decodes_large_jpegs_reduced():
+    img = frame_utils.imdecode_for_detection(encode_jpeg(1920, 2560), 640)
+    assert img.shape == (480, 640, 3)
+    img = frame_utils.imdecode_for_detection(encode_jpeg(480, 640), 640)
+    assert img.shape == (480, 640, 3)